@@ -0,0 +1,157 @@
+"""管理者ダッシュボード用の集計ロールアップ。
+
+承認・交換申請などの更新と同じトランザクション内で record_* を呼び、
+集計テーブルを加算更新する（/admin/analytics は集計テーブルのみを読む）。
+月は参加申請日・交換申請日を基準にする。
+"""
+from datetime import datetime
+
+from sqlalchemy import func, select, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from models import (
+    Event,
+    EventParticipationStat,
+    MonthlyParticipant,
+    MonthlyParticipantStat,
+    MonthlyParticipationStat,
+    MonthlyRedemptionStat,
+    RewardRequest,
+    UserEvent,
+)
+
+
+def month_key(value: datetime) -> str:
+    return (value or datetime.utcnow()).strftime("%Y-%m")
+
+
+def _bump(db, model, keys: dict, **deltas) -> None:
+    # INSERT ... ON CONFLICT DO UPDATE で1文の加算更新
+    stmt = sqlite_insert(model).values(**keys, **deltas)
+    cols = model.__table__.c
+    stmt = stmt.on_conflict_do_update(
+        index_elements=list(keys),
+        set_={k: cols[k] + stmt.excluded[k] for k in deltas},
+    )
+    db.execute(stmt)
+
+
+def _bump_participation(db, event: Event, joined_at: datetime, **deltas) -> None:
+    _bump(db, MonthlyParticipationStat, {"month": month_key(joined_at), "event_type": event.event_type}, **deltas)
+    _bump(db, EventParticipationStat, {"event_id": event.id}, **deltas)
+
+
+def record_join(db, event: Event, ue: UserEvent) -> None:
+    _bump_participation(db, event, ue.joined_at, joins=1)
+    # その月の最初の参加申請のときだけ参加者数を加算
+    month = month_key(ue.joined_at)
+    inserted = db.execute(
+        sqlite_insert(MonthlyParticipant).values(month=month, user_id=ue.user_id).on_conflict_do_nothing()
+    ).rowcount
+    if inserted:
+        _bump(db, MonthlyParticipantStat, {"month": month}, participants=1)
+
+
+def record_approval(db, event: Event, ue: UserEvent, stamps: int) -> None:
+    seconds = 0
+    if ue.joined_at and ue.approved_at:
+        seconds = max(int((ue.approved_at - ue.joined_at).total_seconds()), 0)
+    _bump_participation(db, event, ue.joined_at, approved=1, stamps_issued=stamps, approval_seconds=seconds)
+
+
+def record_rejection(db, event: Event, ue: UserEvent) -> None:
+    _bump_participation(db, event, ue.joined_at, rejected=1)
+
+
+def record_redemption(db, req: RewardRequest) -> None:
+    _bump(db, MonthlyRedemptionStat, {"month": month_key(req.created_at)}, requested=1, stamps_spent=req.stamps_spent)
+
+
+def record_redemption_decisions(db, pending_ids, status: str) -> None:
+    """承認/却下する申請（pending_ids の SELECT）を月別に1文で加算する。
+
+    却下はスタンプを返還するため、消費スタンプからも差し引く。
+    状態を更新する前に呼ぶこと。
+    """
+    month = func.strftime("%Y-%m", RewardRequest.created_at)
+    values = {status: func.count()}
+    if status == "rejected":
+        values["stamps_spent"] = -func.sum(RewardRequest.stamps_spent)
+    sel = (
+        select(month, *values.values())
+        .where(RewardRequest.id.in_(pending_ids))
+        .group_by(month)
+    )
+    stmt = sqlite_insert(MonthlyRedemptionStat).from_select(["month", *values], sel)
+    cols = MonthlyRedemptionStat.__table__.c
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["month"],
+        set_={k: cols[k] + stmt.excluded[k] for k in values},
+    )
+    db.execute(stmt)
+
+
+# 参加記録（p）: 現存分と、削除済みイベントから退避した分（jobs.py purge-deleted-events）
+_PARTICIPATIONS_SQL = """
+    SELECT ue.event_id, ue.joined_at, e.event_type, ue.approval_status, ue.approved_at, ue.stamps_awarded AS stamps
+    FROM user_events ue JOIN events e ON e.id = ue.event_id
+"""
+_ARCHIVED_PARTICIPATIONS_SQL = """
+    SELECT event_id, joined_at, event_type, approval_status, approved_at, stamps_issued
+    FROM user_events_archive
+"""
+
+_PARTICIPATION_AGGREGATES_SQL = """
+    COUNT(*),
+    SUM(p.approval_status = 'approved'),
+    SUM(p.approval_status = 'rejected'),
+    SUM(p.stamps),
+    SUM(CASE WHEN p.approval_status = 'approved' AND p.approved_at IS NOT NULL
+        THEN MAX(CAST((julianday(p.approved_at) - julianday(p.joined_at)) * 86400 AS INTEGER), 0)
+        ELSE 0 END)
+"""
+
+
+def backfill(db) -> None:
+    """既存の参加・交換申請から集計テーブルを作り直す（導入時・不整合時に実行）。
+
+    月別の参加集計には削除済みイベントの退避分も含める（イベント別は現存イベントのみ）。
+    交換申請の消費スタンプは申請時に減算した数を使う（却下分は返還済みとして除く）。
+    """
+    db.execute(text("DELETE FROM stat_participation_monthly"))
+    db.execute(text("DELETE FROM stat_participation_event"))
+    db.execute(text("DELETE FROM stat_redemption_monthly"))
+    db.execute(text("DELETE FROM stat_participant_user_monthly"))
+    db.execute(text("DELETE FROM stat_participants_monthly"))
+    db.execute(text(f"""
+        INSERT INTO stat_participation_monthly
+            (month, event_type, joins, approved, rejected, stamps_issued, approval_seconds)
+        SELECT strftime('%Y-%m', p.joined_at), p.event_type, {_PARTICIPATION_AGGREGATES_SQL}
+        FROM ({_PARTICIPATIONS_SQL} UNION ALL {_ARCHIVED_PARTICIPATIONS_SQL}) p
+        GROUP BY 1, 2
+    """))
+    db.execute(text(f"""
+        INSERT INTO stat_participation_event
+            (event_id, joins, approved, rejected, stamps_issued, approval_seconds)
+        SELECT p.event_id, {_PARTICIPATION_AGGREGATES_SQL}
+        FROM ({_PARTICIPATIONS_SQL}) p
+        GROUP BY 1
+    """))
+    db.execute(text("""
+        INSERT INTO stat_participant_user_monthly (month, user_id)
+        SELECT strftime('%Y-%m', joined_at), user_id FROM user_events
+        UNION
+        SELECT strftime('%Y-%m', joined_at), user_id FROM user_events_archive
+    """))
+    db.execute(text("""
+        INSERT INTO stat_participants_monthly (month, participants)
+        SELECT month, COUNT(*) FROM stat_participant_user_monthly GROUP BY month
+    """))
+    db.execute(text("""
+        INSERT INTO stat_redemption_monthly (month, requested, approved, rejected, stamps_spent)
+        SELECT strftime('%Y-%m', rr.created_at), COUNT(*),
+            SUM(rr.status = 'approved'), SUM(rr.status = 'rejected'),
+            SUM(CASE WHEN rr.status = 'rejected' THEN 0 ELSE rr.stamps_spent END)
+        FROM reward_requests rr
+        GROUP BY 1
+    """))
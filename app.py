@@ -1,8 +1,37 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, g
-from db import SessionLocal
+from datetime import datetime
+
+from flask import Flask, render_template, request, redirect, url_for, session, flash, g, abort, jsonify, Response
+from werkzeug.http import is_resource_modified
+from db import SessionLocal, engine
 from init_db import init_db as ensure_db
-from models import User, Event, UserEvent, Reward, RewardRequest, StampHistory
-from sqlalchemy import func
+from models import (
+    User,
+    Event,
+    UserEvent,
+    Reward,
+    RewardRequest,
+    StampHistory,
+    MonthlyParticipantStat,
+    MonthlyParticipationStat,
+    EventParticipationStat,
+    MonthlyRedemptionStat,
+)
+from sqlalchemy import func, select, update
+from timeutil import parse_date, parse_time
+from search import fts_available, search_events
+import analytics
+from profiling import init_profiler
+import idempotency
+import bulk_grant
+import redemption
+import ical
+import lookup
+import live
+from auth import admin_required, init_auth, is_admin, login_required, user_cache
+
+
+# /events の1ページあたりの表示件数
+EVENTS_PER_PAGE = 20
 
 
 def create_app() -> Flask:
@@ -17,6 +46,17 @@ def create_app() -> Flask:
         # 起動継続。以降のDBアクセス時にエラーが出た場合は手動で init_db.py を実行
         pass
 
+    # 交換申請・参加申請フォームに埋め込む冪等キー
+    app.add_template_global(idempotency.new_key, "new_idempotency_key")
+    # 管理画面の入力補完の表示名
+    app.add_template_global(lookup.user_label, "user_label")
+    app.add_template_global(lookup.event_label, "event_label")
+
+    # カレンダー配信の本文キャッシュ（プロセス単位）
+    feed_cache = ical.FeedCache()
+    # 管理者向け承認待ちキューのライブ配信（プロセス内で1つのポーリングを共有）
+    pending_feed = live.PendingFeed(SessionLocal)
+
     @app.template_filter('ymd')
     def format_ymd(value):
         if value is None:
@@ -28,6 +68,16 @@ def create_app() -> Flask:
             s = str(value)
             return s[:10]
 
+    @app.template_filter('hm')
+    def format_hm(value):
+        if value is None:
+            return ""
+        try:
+            # time -> HH:MM
+            return value.strftime('%H:%M')
+        except Exception:
+            return str(value)[:5]
+
     @app.teardown_appcontext
     def shutdown_session(exception=None):
         # アプリコンテキスト終了時にDBセッションをクローズ
@@ -40,9 +90,33 @@ def create_app() -> Flask:
             g.db = SessionLocal()
         return g.db
 
+    # 管理者向けのリクエスト単位プロファイル（X-Profile ヘッダー / ?_profile=1 / サンプリング）
+    # 利用者の読み込みも計測に含めるため init_auth より前に登録する（権限は保存時に g.user で判定）
+    init_profiler(app, engine)
+
+    # ログイン中の利用者を1リクエスト1回だけ g.user に読み込む（USER_CACHE_TTL でプロセス内キャッシュ）
+    init_auth(app, get_db)
+
+    def query_events(db):
+        # 論理削除済みのイベントは全ての一覧・参照から除外する
+        return db.query(Event).filter(Event.is_deleted.is_(False))
+
+    def get_event(db, event_id: int):
+        return query_events(db).filter(Event.id == event_id).one_or_none()
+
+    def filter_date_range(q):
+        # ?date_from=YYYY-MM-DD&date_to=YYYY-MM-DD で開催日を範囲指定（ix_events_date を利用）
+        date_from = parse_date(request.args.get("date_from"))
+        date_to = parse_date(request.args.get("date_to"))
+        if date_from:
+            q = q.filter(Event.date >= date_from)
+        if date_to:
+            q = q.filter(Event.date <= date_to)
+        return q
+
     @app.route("/")
     def index():
-        if session.get("user_id"):
+        if g.user:
             return redirect(url_for("mypage"))
         return redirect(url_for("login"))
 
@@ -61,8 +135,7 @@ def create_app() -> Flask:
 
             if user and user.password == password:
                 session["user_id"] = user.id
-                session["employee_code"] = user.employee_code
-                session["role"] = user.role
+                user_cache.invalidate(user.id)
                 flash("ログインしました", "success")
                 return redirect(url_for("mypage"))
             else:
@@ -77,21 +150,20 @@ def create_app() -> Flask:
         return redirect(url_for("login"))
 
     @app.route("/mypage")
+    @login_required
     def mypage():
-        user_id = session.get("user_id")
-        if not user_id:
-            return redirect(url_for("login"))
-
         db = get_db()
-        user = db.query(User).filter(User.id == user_id).one_or_none()
-        if not user:
-            session.clear()
-            return redirect(url_for("login"))
+        user = g.user
+        if not user.calendar_token:
+            user.calendar_token = ical.new_token()
+            db.commit()
+            user_cache.invalidate(user.id)
 
         # 参加イベント一覧・直近
         user_event_q = (
             db.query(UserEvent)
-            .filter(UserEvent.user_id == user.id)
+            .join(Event, Event.id == UserEvent.event_id)
+            .filter(UserEvent.user_id == user.id, Event.is_deleted.is_(False))
             .order_by(UserEvent.joined_at.desc())
         )
         recent_user_events = user_event_q.limit(5).all()
@@ -101,7 +173,7 @@ def create_app() -> Flask:
         joined_ids = set(ue.event_id for ue in user_event_q.all())
 
         # 参加状況別リスト
-        all_events = db.query(Event).order_by(Event.date).all()
+        all_events = query_events(db).order_by(Event.date).all()
         joined_active = [e for e in all_events if e.id in joined_ids and e.is_active]
         joined_finished = [e for e in all_events if e.id in joined_ids and not e.is_active]
         finished_not_joined = [e for e in all_events if e.id not in joined_ids and not e.is_active]
@@ -136,32 +208,67 @@ def create_app() -> Flask:
             joined_finished=joined_finished,
             finished_not_joined=finished_not_joined,
             histories=histories,
+            calendar_url=url_for("calendar_feed", token=user.calendar_token, _external=True),
         )
 
     @app.route("/events")
+    @login_required
     def events():
-        user_id = session.get("user_id")
-        if not user_id:
-            return redirect(url_for("login"))
+        user_id = g.user.id
 
         db = get_db()
-        all_events = db.query(Event).order_by(Event.date).all()
+        keyword = request.args.get("q", "").strip()
+        try:
+            page = max(int(request.args.get("page", 1)), 1)
+        except ValueError:
+            page = 1
 
-        # 参加済みのイベントIDセット
-        joined_ids = set(
-            e.event_id for e in db.query(UserEvent).filter(UserEvent.user_id == user_id).all()
-        )
+        q = filter_date_range(query_events(db))
+        if keyword and fts_available(db):
+            q = search_events(q, keyword)
+        else:
+            if keyword:
+                flash("この環境ではキーワード検索を利用できません", "warning")
+            q = q.order_by(Event.date)
+        # 次ページ有無の判定用に1件多く取得
+        rows = q.offset((page - 1) * EVENTS_PER_PAGE).limit(EVENTS_PER_PAGE + 1).all()
+        has_next = len(rows) > EVENTS_PER_PAGE
+        page_events = rows[:EVENTS_PER_PAGE]
+
+        # 参加済みのイベントIDセット（表示中のイベント分のみ）
+        joined_ids = set()
+        if page_events:
+            joined_ids = set(
+                event_id for (event_id,) in db.query(UserEvent.event_id).filter(
+                    UserEvent.user_id == user_id,
+                    UserEvent.event_id.in_([e.id for e in page_events]),
+                )
+            )
 
-        return render_template("events.html", events=all_events, joined_ids=joined_ids, role=session.get("role"))
+        return render_template(
+            "events.html",
+            events=page_events,
+            joined_ids=joined_ids,
+            role=g.user.role,
+            keyword=keyword,
+            page=page,
+            has_next=has_next,
+            args=request.args.to_dict(),
+        )
 
     @app.post("/events/<int:event_id>/join")
+    @login_required
     def join_event(event_id: int):
-        user_id = session.get("user_id")
-        if not user_id:
-            return redirect(url_for("login"))
+        user_id = g.user.id
 
         db = get_db()
-        event = db.query(Event).filter(Event.id == event_id).one_or_none()
+        # 再送（二重クリック等）は初回の結果をそのまま返す
+        key = idempotency.get_key()
+        replayed = idempotency.replay(db, user_id, key)
+        if replayed is not None:
+            return replayed
+
+        event = get_event(db, event_id)
         if not event:
             flash("イベントが見つかりません", "danger")
             return redirect(url_for("events"))
@@ -179,20 +286,19 @@ def create_app() -> Flask:
             flash("すでに参加済みです", "info")
             return redirect(url_for("events"))
 
-        db.add(UserEvent(user_id=user_id, event_id=event_id, approval_status="pending"))
-        db.commit()
-
-        flash("参加申請を受け付けました（承認後にスタンプ付与）", "success")
-        return redirect(url_for("events"))
+        ue = UserEvent(user_id=user_id, event_id=event_id, approval_status="pending", joined_at=datetime.utcnow())
+        db.add(ue)
+        analytics.record_join(db, event, ue)
+        ical.invalidate_feeds(db, [user_id])
+        return idempotency.commit_with_key(
+            db, user_id, key, url_for("events"), "参加申請を受け付けました（承認後にスタンプ付与）"
+        )
 
     @app.get("/events/<int:event_id>")
+    @login_required
     def event_detail(event_id: int):
-        user_id = session.get("user_id")
-        if not user_id:
-            return redirect(url_for("login"))
-
         db = get_db()
-        event = db.query(Event).filter(Event.id == event_id).one_or_none()
+        event = get_event(db, event_id)
         if not event:
             flash("イベントが見つかりません", "danger")
             return redirect(url_for("events"))
@@ -212,17 +318,17 @@ def create_app() -> Flask:
             event=event,
             participants=participants,
             current_count=current_count,
-            role=session.get("role"),
+            role=g.user.role,
         )
 
     @app.post("/events/<int:event_id>/toggle")
     def toggle_event(event_id: int):
-        if session.get("role") != "admin":
+        if not is_admin():
             flash("権限がありません", "danger")
             return redirect(url_for("events"))
 
         db = get_db()
-        event = db.query(Event).filter(Event.id == event_id).one_or_none()
+        event = get_event(db, event_id)
         if not event:
             flash("イベントが見つかりません", "danger")
             return redirect(url_for("events"))
@@ -233,33 +339,61 @@ def create_app() -> Flask:
         return redirect(url_for("event_detail", event_id=event_id))
 
     # ========== Admin ==========
-    def require_admin():
-        if session.get("role") != "admin":
-            flash("管理者のみアクセス可能です", "danger")
-            return False
-        return True
-
     @app.get("/admin")
+    @admin_required
     def admin():
-        if not require_admin():
-            return redirect(url_for("mypage"))
         db = get_db()
-        events = db.query(Event).order_by(Event.date).all()
+        events = filter_date_range(query_events(db)).order_by(Event.date).all()
         rewards = db.query(Reward).order_by(Reward.required_stamps, Reward.name).all()
         users = db.query(User).order_by(User.id).all()
         pending_requests = db.query(RewardRequest).filter(RewardRequest.status == "pending").order_by(RewardRequest.created_at.desc()).all()
-        return render_template("admin.html", events=events, rewards=rewards, users=users, pending_requests=pending_requests)
+        return render_template(
+            "admin.html",
+            events=events,
+            rewards=rewards,
+            users=users,
+            pending_requests=pending_requests,
+            live_cursor=live.current_cursor(db),
+        )
+
+    @app.get("/admin/analytics")
+    @admin_required
+    def admin_analytics():
+        db = get_db()
+        # 集計テーブルのみ参照（生データの全件集計はしない）
+        monthly = (
+            db.query(MonthlyParticipationStat)
+            .order_by(MonthlyParticipationStat.month.desc(), MonthlyParticipationStat.event_type)
+            .all()
+        )
+        top_events = (
+            db.query(EventParticipationStat, Event.title)
+            .join(Event, Event.id == EventParticipationStat.event_id)
+            .filter(Event.is_deleted.is_(False))
+            .order_by(EventParticipationStat.joins.desc())
+            .limit(20)
+            .all()
+        )
+        participants = db.query(MonthlyParticipantStat).order_by(MonthlyParticipantStat.month.desc()).all()
+        user_count = db.scalar(select(func.count()).select_from(User))
+        redemptions = db.query(MonthlyRedemptionStat).order_by(MonthlyRedemptionStat.month.desc()).all()
+        return render_template(
+            "admin_analytics.html",
+            participants=participants,
+            user_count=user_count,
+            monthly=monthly,
+            top_events=top_events,
+            redemptions=redemptions,
+        )
 
     @app.get("/admin/events/new")
+    @admin_required
     def admin_event_new():
-        if not require_admin():
-            return redirect(url_for("mypage"))
         return render_template("admin_event_new.html")
 
     @app.post("/admin/events/new")
+    @admin_required
     def admin_create_event_step1():
-        if not require_admin():
-            return redirect(url_for("mypage"))
         f = request.form
         title = f.get("title", "").strip()
         if not title:
@@ -268,9 +402,9 @@ def create_app() -> Flask:
         db = get_db()
         ev = Event(
             title=title,
-            date=f.get("date") or None,
-            start_time=f.get("start_time") or None,
-            end_time=f.get("end_time") or None,
+            date=parse_date(f.get("date")),
+            start_time=parse_time(f.get("start_time")),
+            end_time=parse_time(f.get("end_time")),
             location=f.get("location") or None,
             contact_name=f.get("contact_name") or None,
             description=f.get("description") or None,
@@ -292,30 +426,28 @@ def create_app() -> Flask:
         return redirect(url_for("admin"))
 
     @app.get("/admin/events/<int:event_id>/edit")
+    @admin_required
     def admin_event_edit(event_id: int):
-        if not require_admin():
-            return redirect(url_for("mypage"))
         db = get_db()
-        event = db.query(Event).filter(Event.id == event_id).one_or_none()
+        event = get_event(db, event_id)
         if not event:
             flash("イベントが見つかりません", "danger")
             return redirect(url_for("admin"))
         return render_template("admin_event_edit.html", event=event)
 
     @app.post("/admin/events/<int:event_id>/edit")
+    @admin_required
     def admin_update_event(event_id: int):
-        if not require_admin():
-            return redirect(url_for("mypage"))
         db = get_db()
-        event = db.query(Event).filter(Event.id == event_id).one_or_none()
+        event = get_event(db, event_id)
         if not event:
             flash("イベントが見つかりません", "danger")
             return redirect(url_for("admin"))
         f = request.form
         event.title = f.get("title") or event.title
-        event.date = f.get("date") or None
-        event.start_time = f.get("start_time") or None
-        event.end_time = f.get("end_time") or None
+        event.date = parse_date(f.get("date"))
+        event.start_time = parse_time(f.get("start_time"))
+        event.end_time = parse_time(f.get("end_time"))
         event.location = f.get("location") or None
         event.contact_name = f.get("contact_name") or None
         event.description = f.get("description") or None
@@ -329,14 +461,15 @@ def create_app() -> Flask:
             event.capacity = int(f.get("capacity")) if f.get("capacity") else None
         except ValueError:
             event.capacity = None
+        # 参加者のカレンダーに日時・場所の変更を反映させる
+        ical.invalidate_feeds(db, select(UserEvent.user_id).where(UserEvent.event_id == event.id))
         db.commit()
         flash("イベントを更新しました", "success")
         return redirect(url_for("admin_event_edit", event_id=event.id))
 
     @app.post("/admin/events/create")
+    @admin_required
     def admin_create_event():
-        if not require_admin():
-            return redirect(url_for("mypage"))
         form = request.form
         title = form.get("title", "").strip()
         if not title:
@@ -345,9 +478,9 @@ def create_app() -> Flask:
         db = get_db()
         event = Event(
             title=title,
-            date=form.get("date") or None,
-            start_time=form.get("start_time") or None,
-            end_time=form.get("end_time") or None,
+            date=parse_date(form.get("date")),
+            start_time=parse_time(form.get("start_time")),
+            end_time=parse_time(form.get("end_time")),
             location=form.get("location") or None,
             contact_name=form.get("contact_name") or None,
             description=form.get("description") or None,
@@ -372,29 +505,30 @@ def create_app() -> Flask:
         return redirect(url_for("admin"))
 
     @app.post("/admin/events/<int:event_id>/delete")
+    @admin_required
     def admin_delete_event(event_id: int):
-        if not require_admin():
-            return redirect(url_for("mypage"))
         db = get_db()
-        event = db.query(Event).filter(Event.id == event_id).one_or_none()
+        event = get_event(db, event_id)
         if not event:
             flash("イベントが見つかりません", "danger")
             return redirect(url_for("admin"))
-        db.delete(event)
+        # 参加記録はリクエスト内では触らず、論理削除のみ（jobs.py purge-deleted-events で後処理）
+        event.is_deleted = True
+        event.is_active = False
+        event.deleted_at = datetime.utcnow()
+        ical.invalidate_feeds(db, select(UserEvent.user_id).where(UserEvent.event_id == event.id))
         db.commit()
         flash("イベントを削除しました", "success")
         return redirect(url_for("admin"))
 
     @app.get("/admin/rewards/new")
+    @admin_required
     def admin_reward_new():
-        if not require_admin():
-            return redirect(url_for("mypage"))
         return render_template("admin_reward_new.html")
 
     @app.post("/admin/rewards/new")
+    @admin_required
     def admin_create_reward():
-        if not require_admin():
-            return redirect(url_for("mypage"))
         name = request.form.get("name", "").strip()
         try:
             required_stamps = int(request.form.get("required_stamps", "0"))
@@ -410,9 +544,8 @@ def create_app() -> Flask:
         return redirect(url_for("admin"))
 
     @app.post("/admin/rewards/<int:reward_id>/delete")
+    @admin_required
     def admin_delete_reward(reward_id: int):
-        if not require_admin():
-            return redirect(url_for("mypage"))
         db = get_db()
         reward = db.query(Reward).filter(Reward.id == reward_id).one_or_none()
         if not reward:
@@ -423,43 +556,72 @@ def create_app() -> Flask:
         flash("景品を削除しました", "success")
         return redirect(url_for("admin"))
 
+    def parse_id_values(values):
+        # チェックボックスの複数値・カンマ区切りの両方を受け付ける
+        ids = []
+        for v in values:
+            for sid in str(v).split(","):
+                try:
+                    ids.append(int(sid))
+                except ValueError:
+                    continue
+        return ids
+
     @app.post("/admin/requests/<int:request_id>/approve")
+    @admin_required
     def admin_approve_request(request_id: int):
-        if not require_admin():
-            return redirect(url_for("mypage"))
         db = get_db()
-        req = db.query(RewardRequest).filter(RewardRequest.id == request_id).one_or_none()
-        if not req:
-            flash("申請が見つかりません", "danger")
+        if not redemption.approve_requests(db, [request_id]):
+            flash("保留中の申請が見つかりません", "danger")
             return redirect(url_for("admin"))
-        req.status = "approved"
         db.commit()
         flash("申請を承認しました", "success")
         return redirect(url_for("admin"))
 
     @app.post("/admin/requests/<int:request_id>/reject")
+    @admin_required
     def admin_reject_request(request_id: int):
-        if not require_admin():
-            return redirect(url_for("mypage"))
         db = get_db()
-        req = db.query(RewardRequest).filter(RewardRequest.id == request_id).one_or_none()
-        if not req:
-            flash("申請が見つかりません", "danger")
+        user_ids = redemption.reject_requests(db, [request_id])
+        if not user_ids:
+            flash("保留中の申請が見つかりません", "danger")
             return redirect(url_for("admin"))
-        req.status = "rejected"
         db.commit()
-        flash("申請を却下しました", "success")
+        user_cache.invalidate(*user_ids)  # 返還で残高が変わる
+        flash("申請を却下しました（スタンプを返還）", "success")
+        return redirect(url_for("admin"))
+
+    @app.post("/admin/requests/approve")
+    @admin_required
+    def admin_approve_requests():
+        db = get_db()
+        count = redemption.approve_requests(db, parse_id_values(request.form.getlist("request_ids")))
+        db.commit()
+        flash(f"{count}件を承認しました", "success")
+        return redirect(url_for("admin"))
+
+    @app.post("/admin/requests/reject")
+    @admin_required
+    def admin_reject_requests():
+        db = get_db()
+        user_ids = redemption.reject_requests(db, parse_id_values(request.form.getlist("request_ids")))
+        db.commit()
+        user_cache.invalidate(*user_ids)  # 返還で残高が変わる
+        flash(f"{len(user_ids)}件を却下しました（スタンプを返還）", "success")
         return redirect(url_for("admin"))
 
     # ========== Stamp Approval (Admin) ==========
     @app.get("/admin/stamps")
+    @admin_required
     def admin_stamps():
-        if not require_admin():
-            return redirect(url_for("mypage"))
         db = get_db()
         user_id = request.args.get("user_id")
         event_id = request.args.get("event_id")
-        q = db.query(UserEvent).filter(UserEvent.approval_status == "pending")
+        q = (
+            db.query(UserEvent)
+            .join(Event, Event.id == UserEvent.event_id)
+            .filter(UserEvent.approval_status == "pending", Event.is_deleted.is_(False))
+        )
         if user_id:
             try:
                 q = q.filter(UserEvent.user_id == int(user_id))
@@ -471,17 +633,58 @@ def create_app() -> Flask:
             except ValueError:
                 pass
         pendings = q.order_by(UserEvent.joined_at.desc()).all()
-        users = db.query(User).order_by(User.id).all()
-        events = db.query(Event).order_by(Event.date).all()
-        return render_template("admin_stamps.html", pendings=pendings, users=users, events=events)
+        # 絞り込み中のユーザー・イベントのみ主キーで引いて表示名にする（候補は入力補完で取得）
+        selected_user = selected_event = None
+        if user_id and user_id.isdigit():
+            selected_user = db.get(User, int(user_id))
+        if event_id and event_id.isdigit():
+            selected_event = get_event(db, int(event_id))
+        return render_template(
+            "admin_stamps.html",
+            pendings=pendings,
+            selected_user=selected_user,
+            selected_event=selected_event,
+            live_cursor=live.current_cursor(db),
+        )
+
+    @app.get("/admin/live/pending")
+    @admin_required
+    def admin_live_pending():
+        # 再接続時はブラウザが送る Last-Event-ID、初回は画面描画時のカーソルから
+        after = request.headers.get("Last-Event-ID", type=int)
+        if after is None:
+            after = request.args.get("after", type=int)
+        if after is None:
+            after = live.current_cursor(get_db())
+        # 配信できないワーカー・上限超過時は 204（ブラウザは再接続せず、画面は再読み込みで更新）
+        if not pending_feed.reserve(request.environ):
+            return "", 204
+        # ストリーム中は DB セッションを保持しない（teardown で閉じられる）
+        return Response(
+            pending_feed.stream(after),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    @app.get("/admin/lookup/users")
+    def admin_lookup_users():
+        if not is_admin():
+            abort(403)
+        return jsonify(lookup.find_users(get_db(), request.args.get("q")))
+
+    @app.get("/admin/lookup/events")
+    def admin_lookup_events():
+        if not is_admin():
+            abort(403)
+        return jsonify(lookup.find_events(get_db(), request.args.get("q")))
 
     @app.post("/admin/stamps/approve")
+    @admin_required
     def admin_stamps_approve():
-        if not require_admin():
-            return redirect(url_for("mypage"))
         db = get_db()
         ids = request.form.getlist("ue_ids")
         count = 0
+        user_ids = set()
         for sid in ids:
             try:
                 ue = db.query(UserEvent).filter(UserEvent.id == int(sid), UserEvent.approval_status == "pending").one_or_none()
@@ -489,10 +692,12 @@ def create_app() -> Flask:
                 ue = None
             if not ue:
                 continue
+            # 画面表示後に論理削除されたイベントの申請は処理しない
+            event = get_event(db, ue.event_id)
+            if not event:
+                continue
             ue.approval_status = "approved"
-            ue.approved_at = func.now()
-            user = db.query(User).filter(User.id == ue.user_id).one()
-            event = db.query(Event).filter(Event.id == ue.event_id).one()
+            ue.approved_at = datetime.utcnow()
             # 付与ポイント
             add = 0
             if event.event_type in ("single", "survey"):
@@ -506,22 +711,34 @@ def create_app() -> Flask:
                     if has_parent:
                         add = event.points or 1
             if add:
-                user.stamps = (user.stamps or 0) + add
-                db.add(StampHistory(user_id=user.id, change=add, reason=f"{event.title} 参加承認"))
+                # 残高は SQL 式で加算（キャッシュ由来の古い値で上書きしない）
+                db.execute(
+                    update(User)
+                    .where(User.id == ue.user_id)
+                    .values(stamps=User.stamps + add)
+                    .execution_options(synchronize_session=False)
+                )
+                db.add(StampHistory(user_id=ue.user_id, change=add, reason=f"{event.title} 参加承認"))
             else:
-                db.add(StampHistory(user_id=user.id, change=0, reason=f"{event.title} は対象外のためスタンプ無し"))
+                db.add(StampHistory(user_id=ue.user_id, change=0, reason=f"{event.title} は対象外のためスタンプ無し"))
+            ue.stamps_awarded = add
+            analytics.record_approval(db, event, ue, add)
+            user_ids.add(ue.user_id)
             count += 1
+        if user_ids:
+            ical.invalidate_feeds(db, user_ids)
         db.commit()
+        user_cache.invalidate(*user_ids)
         flash(f"{count}件を承認しました", "success")
         return redirect(url_for("admin_stamps"))
 
     @app.post("/admin/stamps/reject")
+    @admin_required
     def admin_stamps_reject():
-        if not require_admin():
-            return redirect(url_for("mypage"))
         db = get_db()
         ids = request.form.getlist("ue_ids")
         count = 0
+        user_ids = set()
         for sid in ids:
             try:
                 ue = db.query(UserEvent).filter(UserEvent.id == int(sid), UserEvent.approval_status == "pending").one_or_none()
@@ -529,19 +746,24 @@ def create_app() -> Flask:
                 ue = None
             if not ue:
                 continue
+            event = get_event(db, ue.event_id)
+            if not event:
+                continue
             ue.approval_status = "rejected"
             user = db.query(User).filter(User.id == ue.user_id).one()
-            event = db.query(Event).filter(Event.id == ue.event_id).one()
             db.add(StampHistory(user_id=user.id, change=0, reason=f"{event.title} 不承認のためスタンプ無し"))
+            analytics.record_rejection(db, event, ue)
+            user_ids.add(user.id)
             count += 1
+        if user_ids:
+            ical.invalidate_feeds(db, user_ids)
         db.commit()
         flash(f"{count}件を却下しました", "success")
         return redirect(url_for("admin_stamps"))
 
     @app.post("/admin/stamps/grant")
+    @admin_required
     def admin_stamps_grant():
-        if not require_admin():
-            return redirect(url_for("mypage"))
         db = get_db()
         try:
             user_id = int(request.form.get("user_id"))
@@ -554,21 +776,113 @@ def create_app() -> Flask:
         if not user:
             flash("ユーザーが見つかりません", "danger")
             return redirect(url_for("admin_stamps"))
-        user.stamps = (user.stamps or 0) + amount
-        db.add(StampHistory(user_id=user.id, change=amount, reason=reason))
+        user.stamps = User.stamps + amount
+        db.add(StampHistory(user_id=user_id, change=amount, reason=reason))
         db.commit()
+        user_cache.invalidate(user_id)
         flash("特別付与を反映しました", "success")
         return redirect(url_for("admin_stamps"))
 
+    @app.get("/admin/stamps/bulk")
+    @admin_required
+    def admin_stamps_bulk():
+        return render_template("admin_stamps_bulk.html", preview=None)
+
+    @app.post("/admin/stamps/bulk")
+    @admin_required
+    def admin_stamps_bulk_grant():
+        db = get_db()
+        f = request.form
+        try:
+            amount = int(f.get("amount"))
+        except (TypeError, ValueError):
+            amount = 0
+        if amount == 0:
+            flash("付与スタンプを入力してください", "warning")
+            return redirect(url_for("admin_stamps_bulk"))
+        reason = (f.get("reason") or "一括付与").strip()
+
+        # 対象ユーザーの指定（確定時はプレビューで解決済みの ids / event を受け取る）
+        mode = f.get("mode")
+        user_ids, employee_codes, invalid = [], [], []
+        event = None
+        if mode == "csv":
+            upload = request.files.get("csv_file")
+            if not upload or not upload.filename:
+                flash("CSVファイルを選択してください", "warning")
+                return redirect(url_for("admin_stamps_bulk"))
+            user_ids, employee_codes, invalid = bulk_grant.parse_csv(upload.read())
+        elif mode == "event":
+            try:
+                event = get_event(db, int(f.get("event_id")))
+            except (TypeError, ValueError):
+                event = None
+            if not event:
+                flash("イベントが見つかりません", "danger")
+                return redirect(url_for("admin_stamps_bulk"))
+        else:
+            user_ids, invalid = bulk_grant.parse_id_list(f.get("user_ids"))
+            employee_codes = [c.strip() for c in (f.get("employee_codes") or "").splitlines() if c.strip()]
+        if event is not None:
+            target = bulk_grant.target_by_event(event.id)
+        else:
+            target = bulk_grant.target_by_ids(user_ids, employee_codes)
+
+        if f.get("confirm") != "1":
+            # ドライラン: 件数と対象の一部のみ表示（書き込みなし）
+            count, sample = bulk_grant.preview(db, target)
+            preview = {
+                "mode": "event" if event is not None else "ids",
+                "event": event,
+                "count": count,
+                "sample": sample,
+                "requested": len(user_ids) + len(employee_codes),
+                "invalid": invalid,
+                "user_ids": " ".join(str(i) for i in user_ids),
+                "employee_codes": "\n".join(employee_codes),
+                "amount": amount,
+                "reason": reason,
+            }
+            return render_template("admin_stamps_bulk.html", preview=preview)
+
+        count = bulk_grant.apply(db, target, amount, reason)
+        db.commit()
+        user_cache.clear()
+        flash(f"{count}名に{amount}スタンプを一括付与しました", "success")
+        return redirect(url_for("admin_stamps"))
+
+    @app.get("/calendar/<token>.ics")
+    def calendar_feed(token: str):
+        # カレンダーアプリからの購読用（ログイン不要・トークンで本人を特定）
+        db = get_db()
+        user = db.query(User).filter(User.calendar_token == token).one_or_none()
+        if not user:
+            abort(404)
+        etag = ical.etag_for(user)
+        last_modified = ical.last_modified_for(user)
+        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            # 変更なし: 参加情報の参照も本文の生成もしない
+            resp = app.response_class(status=304)
+        else:
+            body = feed_cache.get(user.id, user.participation_version)
+            if body is None:
+                body = ical.build_calendar(user, ical.load_rows(db, user), request.host)
+                feed_cache.put(user.id, user.participation_version, body)
+            resp = app.response_class(body, mimetype="text/calendar")
+        resp.set_etag(etag)
+        resp.last_modified = last_modified
+        resp.cache_control.private = True
+        resp.cache_control.no_cache = True
+        return resp
+
     @app.get("/rewards")
+    @login_required
     def rewards():
-        user_id = session.get("user_id")
-        if not user_id:
-            return redirect(url_for("login"))
+        user_id = g.user.id
 
         db = get_db()
         rewards = db.query(Reward).order_by(Reward.required_stamps, Reward.name).all()
-        user = db.query(User).filter(User.id == user_id).one()
+        user = g.user
 
         # 自分の最新申請状況（直近10件）
         recent_requests = (
@@ -581,31 +895,48 @@ def create_app() -> Flask:
         return render_template("rewards.html", rewards=rewards, user=user, recent_requests=recent_requests)
 
     @app.post("/rewards/<int:reward_id>/request")
+    @login_required
     def request_reward(reward_id: int):
-        user_id = session.get("user_id")
-        if not user_id:
-            return redirect(url_for("login"))
+        user_id = g.user.id
 
         db = get_db()
-        user = db.query(User).filter(User.id == user_id).one()
+        # 再送（二重クリック・プロキシのリトライ）で二重に減算しない
+        key = idempotency.get_key()
+        replayed = idempotency.replay(db, user_id, key)
+        if replayed is not None:
+            return replayed
+
         reward = db.query(Reward).filter(Reward.id == reward_id).one_or_none()
         if not reward:
             flash("景品が見つかりません", "danger")
             return redirect(url_for("rewards"))
 
-        if (user.stamps or 0) < reward.required_stamps:
+        # スタンプ減算（残高が足りる場合のみ。g.user の残高はキャッシュ由来で古い可能性があるため DB 側で判定）
+        result = db.execute(
+            update(User)
+            .where(User.id == user_id, User.stamps >= reward.required_stamps)
+            .values(stamps=User.stamps - reward.required_stamps)
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount == 0:
             flash("スタンプが不足しています", "warning")
             return redirect(url_for("rewards"))
 
-        # 重複申請を許可するかは運用次第。ここでは常に新規申請を作成。
-        req = RewardRequest(user_id=user_id, reward_id=reward_id, status="pending")
+        # 重複申請を許可するかは運用次第。ここでは常に新規申請を作成（同一キーの再送は除く）。
+        req = RewardRequest(
+            user_id=user_id,
+            reward_id=reward_id,
+            status="pending",
+            created_at=datetime.utcnow(),
+            stamps_spent=reward.required_stamps,
+        )
         db.add(req)
-        # スタンプ減算 + 履歴
-        user.stamps = (user.stamps or 0) - reward.required_stamps
-        db.add(StampHistory(user_id=user.id, change=-reward.required_stamps, reason=f"景品交換申請: {reward.name}"))
-        db.commit()
-        flash("交換申請を受け付けました", "success")
-        return redirect(url_for("rewards"))
+        analytics.record_redemption(db, req)
+        db.add(StampHistory(user_id=user_id, change=-reward.required_stamps, reason=f"景品交換申請: {reward.name}"))
+        response = idempotency.commit_with_key(db, user_id, key, url_for("rewards"), "交換申請を受け付けました")
+        # 確定後に破棄する（確定前だと並行リクエストが減算前の残高を再びキャッシュし得る）
+        user_cache.invalidate(user_id)
+        return response
 
     return app
 
@@ -0,0 +1,123 @@
+"""ログイン中の利用者の読み込みと認可。
+
+before_request で session の user_id から利用者を1リクエスト1回だけ読み込み、g.user に置く。
+USER_CACHE_TTL（秒、既定 0 = 無効）を設定すると、利用者の主要な列をプロセス内に短時間保持し、
+ヒット時は SELECT を省略する。残高・権限・カレンダートークンを変更した処理は
+user_cache.invalidate / clear を呼ぶこと。
+
+キャッシュはプロセスごとなので、他プロセスでの変更は最大 TTL の間だけ表示が古くなり得る。
+残高の加減算は SQL 式（stamps = stamps + n）で行い、古い値で上書きしないようにする。
+"""
+import os
+import threading
+import time
+from functools import wraps
+
+from flask import flash, g, redirect, session, url_for
+from sqlalchemy.orm import make_transient_to_detached
+
+from models import User
+
+# キャッシュする列（それ以外の列は参照時に遅延ロードされる）
+CACHED_COLUMNS = ("id", "employee_code", "role", "stamps", "calendar_token")
+# 期限切れの掃除を始める件数
+CACHE_PRUNE_SIZE = 10000
+
+
+class UserCache:
+    """user_id -> (期限, 列の値) の TTL キャッシュ（スレッドセーフ）。ttl=0 で無効。"""
+
+    def __init__(self, ttl: float = 0):
+        self.ttl = ttl
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int):
+        if not self.ttl:
+            return None
+        with self._lock:
+            item = self._items.get(user_id)
+            if item is None:
+                return None
+            if item[0] < time.monotonic():
+                del self._items[user_id]
+                return None
+            return item[1]
+
+    def put(self, user: User) -> None:
+        if not self.ttl:
+            return
+        data = {name: getattr(user, name) for name in CACHED_COLUMNS}
+        now = time.monotonic()
+        with self._lock:
+            self._items[user.id] = (now + self.ttl, data)
+            if len(self._items) > CACHE_PRUNE_SIZE:
+                self._items = {k: v for k, v in self._items.items() if v[0] >= now}
+
+    def invalidate(self, *user_ids) -> None:
+        with self._lock:
+            for user_id in user_ids:
+                self._items.pop(user_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+
+user_cache = UserCache()
+
+
+def load_user(db, user_id: int):
+    """利用者をセッションに読み込む。キャッシュにあれば SELECT せずに永続状態として復元する。"""
+    data = user_cache.get(user_id)
+    if data is not None:
+        user = User(**data)
+        make_transient_to_detached(user)
+        db.add(user)
+        return user
+    user = db.get(User, user_id)
+    if user is not None:
+        user_cache.put(user)
+    return user
+
+
+def init_auth(app, get_db) -> None:
+    app.config.setdefault("USER_CACHE_TTL", float(os.environ.get("USER_CACHE_TTL", "0")))
+    user_cache.ttl = app.config["USER_CACHE_TTL"]
+
+    @app.before_request
+    def load_current_user():
+        g.user = None
+        user_id = session.get("user_id")
+        if not user_id:
+            return
+        g.user = load_user(get_db(), user_id)
+        if g.user is None:
+            # 削除された利用者のセッションは破棄
+            session.clear()
+
+
+def is_admin() -> bool:
+    return g.user is not None and g.user.role == "admin"
+
+
+def login_required(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if g.user is None:
+            return redirect(url_for("login"))
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+def admin_required(view):
+    # 権限は cookie の role ではなく、読み込んだ利用者の role で判定する
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not is_admin():
+            flash("管理者のみアクセス可能です", "danger")
+            return redirect(url_for("mypage"))
+        return view(*args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,105 @@
+"""スタンプの一括付与。
+
+対象ユーザーは「ユーザーIDの列挙」「CSV」「イベントの承認済み参加者」のいずれかで指定し、
+付与は UPDATE 1回と StampHistory の INSERT ... SELECT 1回で同一トランザクション内に行う。
+"""
+import csv
+import io
+import re
+from datetime import datetime
+from typing import List, Tuple
+
+from sqlalchemy import func, insert, literal, select, update
+
+from models import StampHistory, User, UserEvent
+
+# CSV のヘッダーとして解釈する列名
+USER_ID_HEADERS = ("user_id", "id", "ユーザーid")
+EMPLOYEE_CODE_HEADERS = ("employee_code", "社員コード")
+
+
+def parse_id_list(raw: str) -> Tuple[List[int], List[str]]:
+    """カンマ・空白・改行区切りのユーザーIDを (IDリスト, 解釈できなかった値) に分ける。"""
+    ids, invalid = [], []
+    for token in re.split(r"[\s,]+", raw or ""):
+        if not token:
+            continue
+        try:
+            ids.append(int(token))
+        except ValueError:
+            invalid.append(token)
+    return ids, invalid
+
+
+def parse_csv(data: bytes) -> Tuple[List[int], List[str], List[str]]:
+    """CSV から (ユーザーID, 社員コード, 解釈できなかった値) を取り出す。
+
+    ヘッダー行に user_id / employee_code（社員コード）列があればその列を使い、
+    ヘッダーが無ければ1列目をユーザーIDとみなす。
+    """
+    try:
+        content = data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        content = data.decode("cp932", errors="replace")  # Excel 既定の Shift_JIS
+    rows = [r for r in csv.reader(io.StringIO(content)) if any(c.strip() for c in r)]
+    if not rows:
+        return [], [], []
+    header = [c.strip().lower() for c in rows[0]]
+    col, by_code = 0, False
+    for i, name in enumerate(header):
+        if name in USER_ID_HEADERS + EMPLOYEE_CODE_HEADERS:
+            col, by_code = i, name in EMPLOYEE_CODE_HEADERS
+            rows = rows[1:]
+            break
+    else:
+        if not header[0].isdigit():
+            rows = rows[1:]  # 不明なヘッダーは読み飛ばして1列目をIDとして扱う
+
+    values = [r[col].strip() for r in rows if len(r) > col and r[col].strip()]
+    if by_code:
+        return [], values, []
+    ids, invalid = parse_id_list(" ".join(values))
+    return ids, [], invalid
+
+
+def target_by_ids(user_ids: List[int] = (), employee_codes: List[str] = ()):
+    """指定されたID・社員コードのうち実在するユーザーIDの SELECT。"""
+    cond = User.id.in_(set(user_ids))
+    if employee_codes:
+        cond = cond | User.employee_code.in_(set(employee_codes))
+    return select(User.id.label("user_id")).where(cond)
+
+
+def target_by_event(event_id: int):
+    """イベントの承認済み参加者のユーザーIDの SELECT。"""
+    return (
+        select(UserEvent.user_id.label("user_id"))
+        .where(UserEvent.event_id == event_id, UserEvent.approval_status == "approved")
+        .distinct()
+    )
+
+
+def preview(db, target, limit: int = 20):
+    """(対象人数, 先頭 limit 件のユーザー) を返す（書き込みなし）。"""
+    subq = target.subquery()
+    count = db.scalar(select(func.count()).select_from(subq))
+    sample = db.query(User).filter(User.id.in_(select(subq.c.user_id))).order_by(User.id).limit(limit).all()
+    return count, sample
+
+
+def apply(db, target, amount: int, reason: str) -> int:
+    """対象ユーザーに amount を付与し、履歴を一括登録する（commit は呼び出し側）。"""
+    subq = target.subquery()
+    result = db.execute(
+        update(User)
+        .where(User.id.in_(select(subq.c.user_id)))
+        .values(stamps=User.stamps + amount)
+        .execution_options(synchronize_session=False)
+    )
+    db.execute(
+        insert(StampHistory).from_select(
+            ["user_id", "change", "reason", "created_at"],
+            select(subq.c.user_id, literal(amount), literal(reason), literal(datetime.utcnow())),
+        )
+    )
+    return result.rowcount
@@ -1,6 +1,8 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, declarative_base
 
+from ngram import index_text
+
 
 DATABASE_URL = "sqlite:///test.db"
 
@@ -10,10 +12,15 @@ engine = create_engine(
     connect_args={"check_same_thread": False},
 )
 
+
+@event.listens_for(engine, "connect")
+def _register_sqlite_functions(dbapi_conn, _record):
+    # events_fts_bigram の同期トリガー（init_db.create_event_search_index）が使う
+    dbapi_conn.create_function("fts_bigrams", 1, index_text, deterministic=True)
+
+
 # セッションファクトリ
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
 
 # Base クラス
 Base = declarative_base()
-
-
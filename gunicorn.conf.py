@@ -0,0 +1,68 @@
+"""gunicorn 設定（`gunicorn -c gunicorn.conf.py`）。
+
+環境変数:
+    BIND             待ち受けアドレス（既定 0.0.0.0:8000）
+    WEB_CONCURRENCY  ワーカープロセス数（既定 CPU数 * 2 + 1）
+    GUNICORN_THREADS ワーカーあたりのスレッド数（既定 4。2以上で gthread ワーカー）
+    LIVE_MAX_STREAMS 承認待ちライブ配信の1ワーカーあたりの同時接続数の上限（既定 2、live.py）
+
+承認待ちのライブ配信（/admin/live/pending）は、/admin・/admin/stamps を開いている管理者タブ1つにつき
+gthread のスレッドを1つ占有する（5分ごとに切断してすぐ再接続するため、開いている間はほぼ常時）。
+1ワーカーのうち配信に使うのは LIVE_MAX_STREAMS スレッドまでで、GUNICORN_THREADS との差が
+通常のリクエストに使えるスレッド数になる（GUNICORN_THREADS > LIVE_MAX_STREAMS にすること）。
+同時にライブ更新できる管理者タブはおおむね WEB_CONCURRENCY * LIVE_MAX_STREAMS まで
+（接続は空いているワーカーに偏らず割り振られるため、余裕を持たせる）。
+上限を超えたタブや sync ワーカー（GUNICORN_THREADS=1）では配信せず、画面は再読み込みで更新する。
+"""
+import multiprocessing
+import os
+import time
+
+wsgi_app = "wsgi:app"
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get("GUNICORN_THREADS", "4"))
+worker_class = "gthread" if threads > 1 else "sync"
+
+# アプリの import・スキーマ確認・キャッシュ構築はマスターで1回だけ行う
+preload_app = True
+
+
+def _memory_kb():
+    """(RSS, 固有メモリ USS) を kB で返す（Linux 以外は USS が None）。"""
+    rss = uss = None
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+        rss = int(fields["Rss"].split()[0])
+        uss = int(fields["Private_Clean"].split()[0]) + int(fields["Private_Dirty"].split()[0])
+    except (OSError, KeyError, ValueError):
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss, uss
+
+
+def when_ready(server):
+    rss, uss = _memory_kb()
+    server.log.info("master ready: RSS %s kB, USS %s kB", rss, uss)
+
+
+def pre_fork(server, worker):
+    worker.forked_at = time.monotonic()
+
+
+def post_fork(server, worker):
+    # 親プロセスのコネクションプールを閉じずに破棄し、ワーカーで新しく作り直す
+    from db import engine
+    engine.dispose(close=False)
+
+
+def post_worker_init(worker):
+    rss, uss = _memory_kb()
+    worker.log.info(
+        "worker %s ready in %.1f ms: RSS %s kB, USS %s kB",
+        worker.pid,
+        (time.monotonic() - worker.forked_at) * 1000,
+        rss,
+        uss,
+    )
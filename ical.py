@@ -0,0 +1,154 @@
+"""参加イベントの iCalendar 配信。
+
+カレンダーアプリは数分おきにポーリングするため、利用者ごとの participation_version を
+ETag にして、変更が無ければユーザー1件の参照だけで 304 を返す。
+本文は (user_id, version) をキーにプロセス内でキャッシュし、版数が変わるまで再生成しない。
+参加・承認・イベント編集など、フィードの内容が変わる更新では invalidate_feeds を呼ぶ。
+"""
+import secrets
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy import update
+
+from models import Event, User, UserEvent
+
+# プロセス内キャッシュの上限（利用者数）
+CACHE_SIZE = 1000
+# 時刻未設定のイベントは終日、終了時刻未設定は開始の1時間後とする
+DEFAULT_DURATION = timedelta(hours=1)
+CALENDAR_TIMEZONE = "Asia/Tokyo"
+
+
+def new_token() -> str:
+    return secrets.token_urlsafe(24)
+
+
+def invalidate_feeds(db, user_ids) -> None:
+    """対象ユーザー（ID のリストまたは SELECT）のフィード版数を1文で進める。"""
+    db.execute(
+        update(User)
+        .where(User.id.in_(user_ids))
+        .values(participation_version=User.participation_version + 1, participation_updated_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+
+
+def etag_for(user: User) -> str:
+    return f"{user.id}-{user.participation_version}"
+
+
+def last_modified_for(user: User) -> datetime:
+    # 一度も参加していない利用者は固定値
+    return user.participation_updated_at or datetime(2000, 1, 1)
+
+
+class FeedCache:
+    """(user_id, version) -> 生成済み本文 の LRU キャッシュ（スレッドセーフ）。"""
+
+    def __init__(self, size: int = CACHE_SIZE):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int, version: int):
+        with self._lock:
+            item = self._items.get(user_id)
+            if item is None or item[0] != version:
+                return None
+            self._items.move_to_end(user_id)
+            return item[1]
+
+    def put(self, user_id: int, version: int, body: str) -> None:
+        with self._lock:
+            self._items[user_id] = (version, body)
+            self._items.move_to_end(user_id)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+
+def _escape(value) -> str:
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace(";", "\\;")
+        .replace(",", "\\,")
+        .replace("\r\n", "\\n")
+        .replace("\n", "\\n")
+    )
+
+
+def _fold(line: str) -> str:
+    # RFC 5545: 1行75オクテットまで。続きは空白で始まる行に折り返す
+    data = line.encode("utf-8")
+    if len(data) <= 75:
+        return line
+    parts, current = [], b""
+    for ch in line:
+        b = ch.encode("utf-8")
+        if len(current) + len(b) > (75 if not parts else 74):
+            parts.append(current.decode("utf-8"))
+            current = b""
+        current += b
+    parts.append(current.decode("utf-8"))
+    return "\r\n ".join(parts)
+
+
+def build_calendar(user: User, rows, host: str) -> str:
+    """(UserEvent, Event) の一覧から VCALENDAR を組み立てる。"""
+    stamp = last_modified_for(user).strftime("%Y%m%dT%H%M%SZ")
+    lines = [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        "PRODID:-//stamp-app//participations//JA",
+        "CALSCALE:GREGORIAN",
+        "METHOD:PUBLISH",
+        f"X-WR-CALNAME:{_escape('参加イベント')}",
+        f"X-WR-TIMEZONE:{CALENDAR_TIMEZONE}",
+    ]
+    for ue, event in rows:
+        lines += [
+            "BEGIN:VEVENT",
+            f"UID:event-{event.id}-user-{user.id}@{host}",
+            f"DTSTAMP:{stamp}",
+        ]
+        if event.start_time:
+            start = datetime.combine(event.date, event.start_time)
+            end = datetime.combine(event.date, event.end_time) if event.end_time else start + DEFAULT_DURATION
+            if end <= start:
+                end = start + DEFAULT_DURATION
+            lines += [f"DTSTART:{start:%Y%m%dT%H%M%S}", f"DTEND:{end:%Y%m%dT%H%M%S}"]
+        else:
+            lines += [
+                f"DTSTART;VALUE=DATE:{event.date:%Y%m%d}",
+                f"DTEND;VALUE=DATE:{event.date + timedelta(days=1):%Y%m%d}",
+            ]
+        lines.append(f"SUMMARY:{_escape(event.title)}")
+        if event.location:
+            lines.append(f"LOCATION:{_escape(event.location)}")
+        description = "\n\n".join(v for v in (event.description, event.notes) if v)
+        if description:
+            lines.append(f"DESCRIPTION:{_escape(description)}")
+        lines += [
+            f"STATUS:{'CONFIRMED' if ue.approval_status == 'approved' else 'TENTATIVE'}",
+            "END:VEVENT",
+        ]
+    lines.append("END:VCALENDAR")
+    return "\r\n".join(_fold(line) for line in lines) + "\r\n"
+
+
+def load_rows(db, user: User):
+    """フィード対象（却下以外・開催日あり）の参加とイベント。"""
+    return (
+        db.query(UserEvent, Event)
+        .join(Event, Event.id == UserEvent.event_id)
+        .filter(
+            UserEvent.user_id == user.id,
+            UserEvent.approval_status != "rejected",
+            Event.date.isnot(None),
+            Event.is_deleted.is_(False),
+        )
+        .order_by(Event.date)
+        .all()
+    )
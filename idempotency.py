@@ -0,0 +1,90 @@
+"""POST の冪等キー処理。
+
+フォームの hidden 項目 `idempotency_key`（または `Idempotency-Key` ヘッダー）が付いた POST は、
+初回の結果（flash メッセージとリダイレクト先）を (user_id, key) の主キーで保存する。
+同じキーの再送は主キー1回の参照だけで初回の結果を返し、書き込みは行わない。
+"""
+import uuid
+from datetime import datetime, timedelta
+from typing import Optional
+
+from flask import flash, redirect, request
+from sqlalchemy import DateTime, bindparam, text
+from sqlalchemy.exc import IntegrityError
+
+from models import IdempotencyKey
+
+# キーの保持期間
+KEY_TTL = timedelta(hours=24)
+MAX_KEY_LENGTH = 128
+
+
+def new_key() -> str:
+    return uuid.uuid4().hex
+
+
+def get_key() -> Optional[str]:
+    key = (request.headers.get("Idempotency-Key") or request.form.get("idempotency_key") or "").strip()
+    if not key or len(key) > MAX_KEY_LENGTH:
+        return None
+    return key
+
+
+def replay(db, user_id: int, key: Optional[str]):
+    """保存済みの結果があればそのレスポンスを返す（無ければ None）。"""
+    if not key:
+        return None
+    rec = db.get(IdempotencyKey, (user_id, key))
+    if rec is None:
+        return None
+    if rec.expires_at <= datetime.utcnow():
+        # 期限切れ（掃除前）のキーは新規扱い。保存時の主キー衝突を避けるため削除しておく
+        db.delete(rec)
+        return None
+    flash(rec.message, rec.category)
+    return redirect(rec.location)
+
+
+def commit_with_key(db, user_id: int, key: Optional[str], location: str, message: str, category: str = "success"):
+    """処理結果をキーと同じトランザクションで確定し、レスポンスを返す。
+
+    同じキーの並行リクエストが先に確定していた場合は、こちらをロールバックして先行結果を返す。
+    """
+    if key:
+        now = datetime.utcnow()
+        db.add(IdempotencyKey(
+            user_id=user_id,
+            key=key,
+            location=location,
+            message=message,
+            category=category,
+            created_at=now,
+            expires_at=now + KEY_TTL,
+        ))
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        response = replay(db, user_id, key)
+        if response is not None:
+            return response
+        raise
+    flash(message, category)
+    return redirect(location)
+
+
+def sweep_expired(db, batch_size: int = 1000) -> int:
+    """期限切れキーを batch_size 件ずつ削除する（expires_at のインデックスを利用）。"""
+    total = 0
+    while True:
+        result = db.execute(
+            text(
+                "DELETE FROM idempotency_keys WHERE rowid IN ("
+                " SELECT rowid FROM idempotency_keys WHERE expires_at < :now LIMIT :limit)"
+            ).bindparams(bindparam("now", type_=DateTime)),
+            {"now": datetime.utcnow(), "limit": batch_size},
+        )
+        db.commit()
+        total += result.rowcount
+        if result.rowcount < batch_size:
+            return total
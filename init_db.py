@@ -1,7 +1,12 @@
-from typing import List, Dict
+import logging
+from datetime import date, time
+from typing import List, Dict, Optional
 
 from db import Base, engine, SessionLocal
 from models import User, Event, Reward, UserEvent, StampHistory
+from timeutil import parse_date, parse_time
+
+logger = logging.getLogger(__name__)
 
 
 def create_tables() -> None:
@@ -36,7 +41,44 @@ def migrate_sqlite_schema() -> None:
                 conn.exec_driver_sql("ALTER TABLE events ADD COLUMN points INTEGER NOT NULL DEFAULT 1")
             if "notes" not in cols:
                 conn.exec_driver_sql("ALTER TABLE events ADD COLUMN notes TEXT NULL")
+            if "is_deleted" not in cols:
+                conn.exec_driver_sql("ALTER TABLE events ADD COLUMN is_deleted BOOLEAN NOT NULL DEFAULT 0")
+            if "deleted_at" not in cols:
+                conn.exec_driver_sql("ALTER TABLE events ADD COLUMN deleted_at TEXT NULL")
+            backfill_event_datetimes(conn)
+            conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_events_date ON events (date)")
+            conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_events_title ON events (title)")
+            try:
+                create_event_search_index(conn)
+            except Exception:
+                # FTS5 非対応の SQLite ではイベント検索のみ無効
+                pass
+        # users: カレンダー配信用の列
+        try:
+            user_cols = [r[1] for r in conn.exec_driver_sql("PRAGMA table_info('users')").fetchall()]
+        except Exception:
+            user_cols = []
+        if user_cols:
+            if "calendar_token" not in user_cols:
+                conn.exec_driver_sql("ALTER TABLE users ADD COLUMN calendar_token TEXT NULL")
+            if "participation_version" not in user_cols:
+                conn.exec_driver_sql("ALTER TABLE users ADD COLUMN participation_version INTEGER NOT NULL DEFAULT 0")
+            if "participation_updated_at" not in user_cols:
+                conn.exec_driver_sql("ALTER TABLE users ADD COLUMN participation_updated_at TEXT NULL")
+            conn.exec_driver_sql("CREATE UNIQUE INDEX IF NOT EXISTS ix_users_calendar_token ON users (calendar_token)")
         # rewards テーブルは create_all で作られるが念のため存在確認のみ
+        # reward_requests: 申請時の消費スタンプ数
+        try:
+            rr_cols = [r[1] for r in conn.exec_driver_sql("PRAGMA table_info('reward_requests')").fetchall()]
+        except Exception:
+            rr_cols = []
+        if rr_cols and "stamps_spent" not in rr_cols:
+            conn.exec_driver_sql("ALTER TABLE reward_requests ADD COLUMN stamps_spent INTEGER NOT NULL DEFAULT 0")
+            # 列追加前の申請は申請時の値が残っていないため、現在の必要スタンプ数で埋める
+            conn.exec_driver_sql(
+                "UPDATE reward_requests SET stamps_spent = COALESCE("
+                "(SELECT required_stamps FROM rewards WHERE rewards.id = reward_requests.reward_id), 0)"
+            )
         # user_events: 承認フラグ列
         try:
             ue_cols = [r[1] for r in conn.exec_driver_sql("PRAGMA table_info('user_events')").fetchall()]
@@ -47,6 +89,189 @@ def migrate_sqlite_schema() -> None:
                 conn.exec_driver_sql("ALTER TABLE user_events ADD COLUMN approval_status TEXT NOT NULL DEFAULT 'pending'")
             if "approved_at" not in ue_cols:
                 conn.exec_driver_sql("ALTER TABLE user_events ADD COLUMN approved_at TEXT NULL")
+            if "stamps_awarded" not in ue_cols:
+                conn.exec_driver_sql("ALTER TABLE user_events ADD COLUMN stamps_awarded INTEGER NOT NULL DEFAULT 0")
+                backfill_stamps_awarded(conn)
+        create_pending_change_triggers(conn)
+        conn.commit()
+
+
+# SQLAlchemy の Date/Time 型が SQLite に保存する正規形式
+_DATE_GLOB = "[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]"
+_TIME_GLOB = "[0-9][0-9]:[0-9][0-9]:[0-9][0-9].[0-9][0-9][0-9][0-9][0-9][0-9]"
+
+
+def backfill_event_datetimes(conn) -> None:
+    """旧形式の文字列 date/start_time/end_time を Date/Time 型の保存形式へ変換。
+
+    正規形式に一致しない行のみを対象にするため、移行済みDBでは実質何もしない。
+    解釈できない値（「来週」「午後」など）は NULL にし、元の表記を notes の末尾に残してログに出す。
+    """
+    rows = conn.exec_driver_sql(
+        "SELECT id, date, start_time, end_time, notes FROM events"
+        " WHERE (date IS NOT NULL AND date NOT GLOB ?)"
+        " OR (start_time IS NOT NULL AND start_time NOT GLOB ?)"
+        " OR (end_time IS NOT NULL AND end_time NOT GLOB ?)",
+        (_DATE_GLOB, _TIME_GLOB, _TIME_GLOB),
+    ).fetchall()
+    if not rows:
+        return
+
+    params, unparsed_ids = [], []
+    for event_id, d, st, et, notes in rows:
+        new_date, new_start, new_end = parse_date(d), parse_time(st), parse_time(et)
+        lost = [
+            f"{label}: {str(raw).strip()}"
+            for label, raw, parsed in (("開催日", d, new_date), ("開始時刻", st, new_start), ("終了時刻", et, new_end))
+            if parsed is None and raw is not None and str(raw).strip()
+        ]
+        if lost:
+            notes = ((notes + "\n") if notes else "") + "（移行前の表記）" + " / ".join(lost)
+            unparsed_ids.append(event_id)
+        params.append((
+            new_date.isoformat() if new_date else None,
+            new_start.strftime("%H:%M:%S.%f") if new_start else None,
+            new_end.strftime("%H:%M:%S.%f") if new_end else None,
+            notes,
+            event_id,
+        ))
+
+    conn.exec_driver_sql(
+        "UPDATE events SET date = ?, start_time = ?, end_time = ?, notes = ? WHERE id = ?",
+        params,
+    )
+    if unparsed_ids:
+        logger.warning(
+            "events with unparseable date/time (kept in notes): %s", ", ".join(str(i) for i in unparsed_ids)
+        )
+
+
+def backfill_stamps_awarded(conn) -> None:
+    """列追加前に承認済みの参加記録へ、付与ルール（admin_stamps_approve）どおりのスタンプ数を入れる。
+
+    列の追加時に一度だけ実行する。以降は承認時に実際の付与数を保存する。
+    """
+    conn.exec_driver_sql("""
+        UPDATE user_events AS ue SET stamps_awarded = COALESCE((
+            SELECT CASE
+                WHEN e.event_type IN ('single', 'survey') THEN COALESCE(NULLIF(e.points, 0), 1)
+                WHEN e.event_type = 'practice' AND e.parent_event_id IS NOT NULL AND EXISTS (
+                    SELECT 1 FROM user_events p WHERE p.user_id = ue.user_id AND p.event_id = e.parent_event_id
+                ) THEN COALESCE(NULLIF(e.points, 0), 1)
+                ELSE 0
+            END
+            FROM events e WHERE e.id = ue.event_id
+        ), 0)
+        WHERE ue.approval_status = 'approved'
+    """)
+
+
+def create_event_search_index(conn) -> None:
+    """events の全文検索用 FTS5 テーブルと同期トリガーを作成。
+
+    日本語は単語区切りがないため trigram トークナイザを使う（3文字以上の部分一致）。
+    3文字未満の語を含む検索は events_fts_bigram（2文字ずつに分けた本文の索引。ngram.py 参照）で引く。
+    テーブルを新規作成した場合のみ既存イベントから索引を再構築する。
+    """
+    exists = conn.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'events_fts'"
+    ).first()
+    if not exists:
+        conn.exec_driver_sql(
+            "CREATE VIRTUAL TABLE events_fts USING fts5("
+            "title, description, location, notes,"
+            " content='events', content_rowid='id', tokenize='trigram')"
+        )
+        conn.exec_driver_sql("INSERT INTO events_fts(events_fts) VALUES ('rebuild')")
+    conn.exec_driver_sql(
+        "CREATE TRIGGER IF NOT EXISTS events_fts_ai AFTER INSERT ON events BEGIN"
+        " INSERT INTO events_fts(rowid, title, description, location, notes)"
+        " VALUES (new.id, new.title, new.description, new.location, new.notes);"
+        " END"
+    )
+    conn.exec_driver_sql(
+        "CREATE TRIGGER IF NOT EXISTS events_fts_ad AFTER DELETE ON events BEGIN"
+        " INSERT INTO events_fts(events_fts, rowid, title, description, location, notes)"
+        " VALUES ('delete', old.id, old.title, old.description, old.location, old.notes);"
+        " END"
+    )
+    # is_active の切り替えなど検索対象外の更新では索引を触らない
+    conn.exec_driver_sql(
+        "CREATE TRIGGER IF NOT EXISTS events_fts_au AFTER UPDATE OF title, description, location, notes ON events BEGIN"
+        " INSERT INTO events_fts(events_fts, rowid, title, description, location, notes)"
+        " VALUES ('delete', old.id, old.title, old.description, old.location, old.notes);"
+        " INSERT INTO events_fts(rowid, title, description, location, notes)"
+        " VALUES (new.id, new.title, new.description, new.location, new.notes);"
+        " END"
+    )
+
+    # bigram 索引: 本文は持たず（content=''）、fts_bigrams（db.py で登録）で分けた語だけを索引する
+    exists = conn.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'events_fts_bigram'"
+    ).first()
+    if not exists:
+        conn.exec_driver_sql(
+            "CREATE VIRTUAL TABLE events_fts_bigram USING fts5("
+            "title, description, location, notes, content='', tokenize='unicode61')"
+        )
+        conn.exec_driver_sql(
+            "INSERT INTO events_fts_bigram(rowid, title, description, location, notes)"
+            " SELECT id, fts_bigrams(title), fts_bigrams(description),"
+            " fts_bigrams(location), fts_bigrams(notes) FROM events"
+        )
+    conn.exec_driver_sql(
+        "CREATE TRIGGER IF NOT EXISTS events_fts_bigram_ai AFTER INSERT ON events BEGIN"
+        " INSERT INTO events_fts_bigram(rowid, title, description, location, notes)"
+        " VALUES (new.id, fts_bigrams(new.title), fts_bigrams(new.description),"
+        " fts_bigrams(new.location), fts_bigrams(new.notes));"
+        " END"
+    )
+    conn.exec_driver_sql(
+        "CREATE TRIGGER IF NOT EXISTS events_fts_bigram_ad AFTER DELETE ON events BEGIN"
+        " INSERT INTO events_fts_bigram(events_fts_bigram, rowid, title, description, location, notes)"
+        " VALUES ('delete', old.id, fts_bigrams(old.title), fts_bigrams(old.description),"
+        " fts_bigrams(old.location), fts_bigrams(old.notes));"
+        " END"
+    )
+    conn.exec_driver_sql(
+        "CREATE TRIGGER IF NOT EXISTS events_fts_bigram_au AFTER UPDATE OF title, description, location, notes ON events BEGIN"
+        " INSERT INTO events_fts_bigram(events_fts_bigram, rowid, title, description, location, notes)"
+        " VALUES ('delete', old.id, fts_bigrams(old.title), fts_bigrams(old.description),"
+        " fts_bigrams(old.location), fts_bigrams(old.notes));"
+        " INSERT INTO events_fts_bigram(rowid, title, description, location, notes)"
+        " VALUES (new.id, fts_bigrams(new.title), fts_bigrams(new.description),"
+        " fts_bigrams(new.location), fts_bigrams(new.notes));"
+        " END"
+    )
+
+
+def create_pending_change_triggers(conn) -> None:
+    """承認待ちキューに出入りする変更を pending_changes に記録するトリガーを作成（live.py が配信）。
+
+    一括承認・一括却下などの set-based な UPDATE も含めて拾えるよう、アプリではなくトリガーで記録する。
+    """
+    for kind, table, status in (
+        ("user_event", "user_events", "approval_status"),
+        ("reward_request", "reward_requests", "status"),
+    ):
+        conn.exec_driver_sql(
+            f"CREATE TRIGGER IF NOT EXISTS {table}_pending_ai AFTER INSERT ON {table}"
+            f" WHEN new.{status} = 'pending' BEGIN"
+            f" INSERT INTO pending_changes (kind, item_id, created_at) VALUES ('{kind}', new.id, datetime('now'));"
+            " END"
+        )
+        conn.exec_driver_sql(
+            f"CREATE TRIGGER IF NOT EXISTS {table}_pending_au AFTER UPDATE OF {status} ON {table}"
+            f" WHEN (old.{status} = 'pending') != (new.{status} = 'pending') BEGIN"
+            f" INSERT INTO pending_changes (kind, item_id, created_at) VALUES ('{kind}', new.id, datetime('now'));"
+            " END"
+        )
+        conn.exec_driver_sql(
+            f"CREATE TRIGGER IF NOT EXISTS {table}_pending_ad AFTER DELETE ON {table}"
+            f" WHEN old.{status} = 'pending' BEGIN"
+            f" INSERT INTO pending_changes (kind, item_id, created_at) VALUES ('{kind}', old.id, datetime('now'));"
+            " END"
+        )
 
 
 def seed_initial_users() -> None:
@@ -94,7 +319,7 @@ def init_db() -> None:
     # 既存DBにも不足分のみ追加するシード
     session = SessionLocal()
     try:
-        def get_or_create(title: str, description: str, date: str, event_type: str, parent_title: str = None):
+        def get_or_create(title: str, description: str, event_date: date, event_type: str, parent_title: Optional[str] = None):
             ex = session.query(Event).filter(Event.title == title).one_or_none()
             if ex:
                 return ex
@@ -103,90 +328,90 @@ def init_db() -> None:
                 parent = session.query(Event).filter(Event.title == parent_title).one_or_none()
                 if parent:
                     parent_id = parent.id
-            ev = Event(title=title, description=description, date=date, event_type=event_type, parent_event_id=parent_id)
+            ev = Event(title=title, description=description, date=event_date, event_type=event_type, parent_event_id=parent_id)
             session.add(ev)
             session.flush()
             return ev
 
         # 年間（親）を先に用意
-        annual_futsal = get_or_create("フットサルクラブ（年間）", "年間を通して活動", "2025-01-01", "annual")
-        annual_marathon = get_or_create("マラソン練習クラブ（年間）", "年間ラン練習", "2025-01-01", "annual")
+        annual_futsal = get_or_create("フットサルクラブ（年間）", "年間を通して活動", date(2025, 1, 1), "annual")
+        annual_marathon = get_or_create("マラソン練習クラブ（年間）", "年間ラン練習", date(2025, 1, 1), "annual")
 
         # 単発/アンケート（拡張フィールド付きで上書き）
-        get_or_create("健康セミナー: 睡眠編", "良質な睡眠とは", "2025-09-25", "single")
+        get_or_create("健康セミナー: 睡眠編", "良質な睡眠とは", date(2025, 9, 25), "single")
         sem = session.query(Event).filter(Event.title == "健康セミナー: 睡眠編").one()
         sem.location = sem.location or "会議室A"
-        sem.start_time = sem.start_time or "10:00"
-        sem.end_time = sem.end_time or "11:00"
+        sem.start_time = sem.start_time or time(10, 0)
+        sem.end_time = sem.end_time or time(11, 0)
         sem.capacity = sem.capacity or 30
         sem.contact_name = sem.contact_name or "総務 太郎"
         sem.points = sem.points or 1
         sem.notes = sem.notes or "入室は開始10分前から"
 
-        get_or_create("社内ゴルフコンペ", "初心者歓迎", "2025-10-12", "single")
+        get_or_create("社内ゴルフコンペ", "初心者歓迎", date(2025, 10, 12), "single")
         golf = session.query(Event).filter(Event.title == "社内ゴルフコンペ").one()
         golf.location = golf.location or "〇〇カントリークラブ"
-        golf.start_time = golf.start_time or "08:00"
-        golf.end_time = golf.end_time or "15:00"
+        golf.start_time = golf.start_time or time(8, 0)
+        golf.end_time = golf.end_time or time(15, 0)
         golf.capacity = golf.capacity or 24
         golf.contact_name = golf.contact_name or "人事 花子"
         golf.points = golf.points or 2
         golf.notes = golf.notes or "レンタルクラブ有"
 
-        get_or_create("市民マラソン大会", "10km/ハーフ", "2025-11-03", "single")
+        get_or_create("市民マラソン大会", "10km/ハーフ", date(2025, 11, 3), "single")
         run = session.query(Event).filter(Event.title == "市民マラソン大会").one()
         run.location = run.location or "市役所前スタート"
-        run.start_time = run.start_time or "09:00"
-        run.end_time = run.end_time or "13:00"
+        run.start_time = run.start_time or time(9, 0)
+        run.end_time = run.end_time or time(13, 0)
         run.capacity = run.capacity or 100
         run.contact_name = run.contact_name or "健康推進部"
         run.points = run.points or 2
         run.notes = run.notes or "雨天決行"
 
-        get_or_create("健康経営アンケート(秋)", "所要3分", "2025-10-01", "survey")
+        get_or_create("健康経営アンケート(秋)", "所要3分", date(2025, 10, 1), "survey")
         ank = session.query(Event).filter(Event.title == "健康経営アンケート(秋)").one()
         ank.location = ank.location or "オンラインURL"
-        ank.start_time = ank.start_time or "00:00"
-        ank.end_time = ank.end_time or "23:59"
+        ank.start_time = ank.start_time or time(0, 0)
+        ank.end_time = ank.end_time or time(23, 59)
         ank.capacity = ank.capacity or None
         ank.contact_name = ank.contact_name or "コーポレート部門"
         ank.points = ank.points or 1
         ank.notes = ank.notes or "匿名回答可"
 
-        get_or_create("社内掲示写真 募集(秋)", "テーマ: スポーツの秋", "2025-10-10", "survey")
+        get_or_create("社内掲示写真 募集(秋)", "テーマ: スポーツの秋", date(2025, 10, 10), "survey")
         pic = session.query(Event).filter(Event.title == "社内掲示写真 募集(秋)").one()
         pic.location = pic.location or "オンライン提出"
-        pic.start_time = pic.start_time or "00:00"
-        pic.end_time = pic.end_time or "23:59"
+        pic.start_time = pic.start_time or time(0, 0)
+        pic.end_time = pic.end_time or time(23, 59)
         pic.capacity = pic.capacity or None
         pic.contact_name = pic.contact_name or "広報 課"
         pic.points = pic.points or 1
         pic.notes = pic.notes or "JPEG/PNG可"
 
         # 練習（子）
-        get_or_create("フットサル練習 10月第1週", "社内体育館", "2025-10-05", "practice", parent_title="フットサルクラブ（年間）")
+        get_or_create("フットサル練習 10月第1週", "社内体育館", date(2025, 10, 5), "practice", parent_title="フットサルクラブ（年間）")
         p1 = session.query(Event).filter(Event.title == "フットサル練習 10月第1週").one()
         p1.location = p1.location or "社内体育館"
-        p1.start_time = p1.start_time or "19:00"
-        p1.end_time = p1.end_time or "21:00"
+        p1.start_time = p1.start_time or time(19, 0)
+        p1.end_time = p1.end_time or time(21, 0)
         p1.capacity = p1.capacity or 20
         p1.contact_name = p1.contact_name or "運営 佐藤"
         p1.points = p1.points or 1
 
-        get_or_create("フットサル練習 10月第3週", "社内体育館", "2025-10-19", "practice", parent_title="フットサルクラブ（年間）")
+        get_or_create("フットサル練習 10月第3週", "社内体育館", date(2025, 10, 19), "practice", parent_title="フットサルクラブ（年間）")
         p2 = session.query(Event).filter(Event.title == "フットサル練習 10月第3週").one()
         p2.location = p2.location or "社内体育館"
-        p2.start_time = p2.start_time or "19:00"
-        p2.end_time = p2.end_time or "21:00"
+        p2.start_time = p2.start_time or time(19, 0)
+        p2.end_time = p2.end_time or time(21, 0)
         p2.capacity = p2.capacity or 20
         p2.contact_name = p2.contact_name or "運営 佐藤"
         p2.points = p2.points or 1
 
-        get_or_create("ラン練習 10kmビルドアップ", "土曜朝", "2025-10-12", "practice", parent_title="マラソン練習クラブ（年間）")
+        get_or_create("ラン練習 10kmビルドアップ", "土曜朝", date(2025, 10, 12), "practice", parent_title="マラソン練習クラブ（年間）")
         p3 = session.query(Event).filter(Event.title == "ラン練習 10kmビルドアップ").one()
         p3.location = p3.location or "会社前集合"
-        p3.start_time = p3.start_time or "07:00"
-        p3.end_time = p3.end_time or "08:30"
+        p3.start_time = p3.start_time or time(7, 0)
+        p3.end_time = p3.end_time or time(8, 30)
         p3.capacity = p3.capacity or 30
         p3.contact_name = p3.contact_name or "コーチ 山田"
         p3.points = p3.points or 1
@@ -0,0 +1,146 @@
+"""定期実行ジョブ（cron などから `python jobs.py <job>` で起動）。"""
+import argparse
+from datetime import date, datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import delete, insert, literal, select, update
+
+import analytics
+import idempotency
+from db import SessionLocal
+from models import Event, EventParticipationStat, PendingChange, UserEvent, UserEventArchive
+
+
+def close_past_events(today: Optional[date] = None) -> int:
+    """開催日を過ぎた受付中イベントを1回の UPDATE でまとめて終了にする。"""
+    today = today or date.today()
+    session = SessionLocal()
+    try:
+        result = session.execute(
+            update(Event)
+            .where(Event.is_active.is_(True), Event.date < today)
+            .values(is_active=False)
+            .execution_options(synchronize_session=False)
+        )
+        session.commit()
+        return result.rowcount
+    finally:
+        session.close()
+
+
+def backfill_analytics() -> str:
+    """集計テーブルを既存データから作り直す。"""
+    session = SessionLocal()
+    try:
+        analytics.backfill(session)
+        session.commit()
+        return "done"
+    finally:
+        session.close()
+
+
+def sweep_idempotency_keys() -> int:
+    """期限切れの冪等キーをバッチ削除する。"""
+    session = SessionLocal()
+    try:
+        return idempotency.sweep_expired(session)
+    finally:
+        session.close()
+
+
+def purge_deleted_events(older_than: timedelta = timedelta(days=7), batch_size: int = 1000) -> str:
+    """論理削除から older_than 経過したイベントを物理削除する。
+
+    参加記録は user_events_archive へ batch_size 件ずつ INSERT ... SELECT / DELETE で退避し、
+    バッチごとに commit する（長時間のロックを避ける）。
+    """
+    session = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        event_ids = session.scalars(
+            select(Event.id).where(Event.is_deleted.is_(True), Event.deleted_at <= now - older_than)
+        ).all()
+        if not event_ids:
+            return "0 events"
+
+        archived = 0
+        while True:
+            batch = session.scalars(
+                select(UserEvent.id).where(UserEvent.event_id.in_(event_ids)).limit(batch_size)
+            ).all()
+            if not batch:
+                break
+            # 種別と付与スタンプ数も残し、退避後も analytics.backfill で月別集計を作り直せるようにする
+            session.execute(
+                insert(UserEventArchive).from_select(
+                    [
+                        "user_event_id", "user_id", "event_id", "event_title", "event_type",
+                        "joined_at", "approval_status", "approved_at", "stamps_issued", "archived_at",
+                    ],
+                    select(
+                        UserEvent.id,
+                        UserEvent.user_id,
+                        UserEvent.event_id,
+                        Event.title,
+                        Event.event_type,
+                        UserEvent.joined_at,
+                        UserEvent.approval_status,
+                        UserEvent.approved_at,
+                        UserEvent.stamps_awarded,
+                        literal(now),
+                    )
+                    .join(Event, Event.id == UserEvent.event_id)
+                    .where(UserEvent.id.in_(batch)),
+                )
+            )
+            session.execute(
+                delete(UserEvent).where(UserEvent.id.in_(batch)).execution_options(synchronize_session=False)
+            )
+            session.commit()
+            archived += len(batch)
+
+        session.execute(
+            delete(EventParticipationStat)
+            .where(EventParticipationStat.event_id.in_(event_ids))
+            .execution_options(synchronize_session=False)
+        )
+        session.execute(delete(Event).where(Event.id.in_(event_ids)).execution_options(synchronize_session=False))
+        session.commit()
+        return f"{len(event_ids)} events, {archived} participations archived"
+    finally:
+        session.close()
+
+
+def prune_pending_changes(older_than: timedelta = timedelta(days=1)) -> int:
+    """ライブ配信済みの承認待ち変更ログを削除する（再接続で再送できるのは保持期間内のみ）。"""
+    session = SessionLocal()
+    try:
+        result = session.execute(
+            delete(PendingChange)
+            .where(PendingChange.created_at < datetime.utcnow() - older_than)
+            .execution_options(synchronize_session=False)
+        )
+        session.commit()
+        return result.rowcount
+    finally:
+        session.close()
+
+
+JOBS = {
+    "close-past-events": close_past_events,
+    "backfill-analytics": backfill_analytics,
+    "sweep-idempotency-keys": sweep_idempotency_keys,
+    "purge-deleted-events": purge_deleted_events,
+    "prune-pending-changes": prune_pending_changes,
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("job", choices=sorted(JOBS))
+    args = parser.parse_args()
+    print(f"{args.job}: {JOBS[args.job]()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+"""管理者向け承認待ちキューのライブ配信（Server-Sent Events）。
+
+参加申請・景品交換申請が承認待ちに入った・出たことは、init_db のトリガーが pending_changes に記録する。
+プロセスごとに1つのポーリングスレッドが pending_changes.id をカーソルにして POLL_INTERVAL ごとに
+新しい行だけを主キーの範囲で読み、接続中の全クライアントへ配る。変更が無い間の DB アクセスは
+接続数によらず間隔ごとに1文だけになる。
+
+スレッドは最初のクライアント接続時に起動し、接続が無くなると停止する
+（gunicorn の preload_app でもマスタープロセスではスレッドを起動しない）。
+
+接続中のストリームはそれぞれワーカーのスレッドを1つ占有するため、1プロセスの同時配信数を
+MAX_STREAMS に制限し、1スレッドのワーカー（gunicorn の sync）では配信しない（gunicorn.conf.py 参照）。
+枠は reserve() で確保し、stream() の応答を閉じたときに返す。
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from sqlalchemy import func, select
+
+from models import Event, PendingChange, Reward, RewardRequest, User, UserEvent
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 2.0
+# 1回のポーリングで読む変更の上限
+BATCH_SIZE = 500
+# 再接続（Last-Event-ID）時に再送できる変更の件数
+BACKLOG_SIZE = 1000
+KEEPALIVE_SECONDS = 15
+# 1接続がワーカーのスレッドを占有し続けないよう一定時間で切り、ブラウザに再接続させる
+STREAM_MAX_SECONDS = 300
+RETRY_MS = 3000
+# 1プロセスで同時に配信するストリーム数の上限（残りのスレッドは通常のリクエストに回す）
+MAX_STREAMS = int(os.environ.get("LIVE_MAX_STREAMS", "2"))
+
+
+def current_cursor(db) -> int:
+    """画面描画時点のカーソル。EventSource の ?after= に渡し、描画後の変更から受け取る。"""
+    return db.scalar(select(func.max(PendingChange.id))) or 0
+
+
+def _format(event: str, data, event_id=None) -> str:
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{head}event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def describe_changes(db, rows):
+    """(change_id, kind, item_id) の一覧から、項目ごとの最新状態を change_id 順に返す。
+
+    承認待ちのものは表示用の値を付け、承認待ちでなくなったもの（承認・却下・削除）は pending=False にする。
+    """
+    latest = {}
+    for change_id, kind, item_id in rows:
+        latest[(kind, item_id)] = change_id
+    ue_ids = [item_id for kind, item_id in latest if kind == "user_event"]
+    rr_ids = [item_id for kind, item_id in latest if kind == "reward_request"]
+
+    details = {}
+    if ue_ids:
+        for ue_id, joined_at, user_id, code, event_id, title, points in (
+            db.query(
+                UserEvent.id, UserEvent.joined_at, User.id, User.employee_code, Event.id, Event.title, Event.points
+            )
+            .join(User, User.id == UserEvent.user_id)
+            .join(Event, Event.id == UserEvent.event_id)
+            .filter(UserEvent.id.in_(ue_ids), UserEvent.approval_status == "pending", Event.is_deleted.is_(False))
+        ):
+            details[("user_event", ue_id)] = {
+                "user_id": user_id,
+                "employee_code": code,
+                "event_id": event_id,
+                "event_title": title,
+                "joined_at": joined_at.strftime("%Y-%m-%d") if joined_at else "",
+                "points": points or 1,
+            }
+    if rr_ids:
+        for rr_id, code, reward_name in (
+            db.query(RewardRequest.id, User.employee_code, Reward.name)
+            .join(User, User.id == RewardRequest.user_id)
+            .join(Reward, Reward.id == RewardRequest.reward_id)
+            .filter(RewardRequest.id.in_(rr_ids), RewardRequest.status == "pending")
+        ):
+            details[("reward_request", rr_id)] = {"employee_code": code, "reward_name": reward_name}
+
+    items = []
+    for (kind, item_id), change_id in sorted(latest.items(), key=lambda kv: kv[1]):
+        detail = details.get((kind, item_id))
+        payload = {"kind": kind, "id": item_id, "pending": detail is not None}
+        payload.update(detail or {})
+        items.append((change_id, payload))
+    return items
+
+
+class PendingFeed:
+    """プロセス内で1つのポーリングを全クライアントに配る。"""
+
+    def __init__(self, session_factory, interval: float = POLL_INTERVAL, max_streams: int = MAX_STREAMS):
+        self.session_factory = session_factory
+        self.interval = interval
+        self.max_streams = max_streams
+        self._cond = threading.Condition()
+        self._items = deque(maxlen=BACKLOG_SIZE)  # (change_id, payload)
+        self._cursor = None  # 読み込み済みの最大 change_id
+        self._floor = None   # これより後の変更はすべて _items にある
+        self._clients = 0
+        self._running = False
+
+    def reserve(self, environ) -> bool:
+        """このワーカーでストリームの枠を1つ確保する。確保できたら必ず stream() を返すこと。
+
+        上限の確認と確保を同じロックの中で行う（並行する接続が同時に上限を超えない）。
+        1スレッドのワーカーではストリームがワーカー全体を占有し、ワーカーのタイムアウトで
+        強制終了されるため配信しない。
+        """
+        if not environ.get("wsgi.multithread"):
+            return False
+        with self._cond:
+            if self._clients >= self.max_streams:
+                return False
+            self._clients += 1
+            return True
+
+    def stream(self, after: int) -> "_Stream":
+        """reserve() で確保した枠で after より後の変更を SSE で送る。
+
+        枠はジェネレーターの終了時に返す。送信を始める前に接続が切れてジェネレーターが
+        開始されなかった場合も、WSGI サーバーが応答の close() を呼んだ時点で返す。
+        """
+        return _Stream(self, self._events(after))
+
+    def _release(self) -> None:
+        with self._cond:
+            self._clients -= 1
+
+    def _events(self, after: int):
+        with self._cond:
+            if not self._running:
+                self._cursor = self._floor = after
+                self._items.clear()
+                self._running = True
+                threading.Thread(target=self._run, name="pending-feed", daemon=True).start()
+        try:
+            yield f"retry: {RETRY_MS}\n\n"
+            cursor = after
+            deadline = time.monotonic() + STREAM_MAX_SECONDS
+            while time.monotonic() < deadline:
+                with self._cond:
+                    if cursor < self._floor:
+                        # 保持していない範囲からの再接続。画面を読み直してもらう
+                        items = None
+                    else:
+                        self._cond.wait_for(lambda: self._cursor > cursor, timeout=KEEPALIVE_SECONDS)
+                        items = [item for item in self._items if item[0] > cursor]
+                        latest = self._cursor
+                if items is None:
+                    yield _format("reset", {})
+                    return
+                if not items:
+                    # データ無しの id 行で Last-Event-ID だけ進める（再接続時の起点を新しく保つ）
+                    cursor = max(cursor, latest)
+                    yield f"id: {cursor}\n\n"
+                    continue
+                for change_id, payload in items:
+                    yield _format("pending", payload, change_id)
+                cursor = items[-1][0]
+        finally:
+            self._release()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            with self._cond:
+                if self._clients == 0:
+                    self._running = False
+                    return
+                cursor = self._cursor
+            try:
+                items = self._poll(cursor)
+            except Exception:
+                logger.exception("pending feed poll failed")
+                continue
+            if not items:
+                continue
+            with self._cond:
+                for item in items:
+                    if len(self._items) == self._items.maxlen:
+                        self._floor = self._items[0][0]
+                    self._items.append(item)
+                self._cursor = items[-1][0]
+                self._cond.notify_all()
+
+    def _poll(self, cursor: int):
+        db = self.session_factory()
+        try:
+            rows = db.execute(
+                select(PendingChange.id, PendingChange.kind, PendingChange.item_id)
+                .where(PendingChange.id > cursor)
+                .order_by(PendingChange.id)
+                .limit(BATCH_SIZE)
+            ).all()
+            if not rows:
+                return []
+            return describe_changes(db, rows)
+        finally:
+            db.close()
+
+
+class _Stream:
+    """PendingFeed.stream() の応答本体。枠をちょうど1回だけ返す。"""
+
+    def __init__(self, feed: PendingFeed, events):
+        self._feed = feed
+        self._events = events
+        self._started = False
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        self._started = True
+        return next(self._events)
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        # 開始済みのジェネレーターは close() で finally が実行され、そこで枠を返す
+        self._events.close()
+        if not self._started:
+            self._feed._release()
@@ -0,0 +1,46 @@
+"""管理画面の入力補完（社員コード・イベント名の前方一致検索）。
+
+LIKE 'x%' は大文字小文字を区別しないため BINARY 照合のインデックスを使えない。
+そこで前方一致を「prefix <= 列 < prefix の次の文字列」の範囲条件にし、
+users.employee_code / events.title のインデックスを範囲走査して上位 LOOKUP_LIMIT 件だけ返す。
+"""
+from sqlalchemy import and_
+
+from models import Event, User
+
+# 1回の補完で返す最大件数
+LOOKUP_LIMIT = 20
+
+
+def prefix_filter(col, prefix: str):
+    """列の前方一致をインデックスで引ける範囲条件にする。"""
+    last = ord(prefix[-1])
+    if last >= 0x10FFFF:
+        return col >= prefix
+    return and_(col >= prefix, col < prefix[:-1] + chr(last + 1))
+
+
+def user_label(user: User) -> str:
+    return f"{user.employee_code} (ID:{user.id})"
+
+
+def event_label(event: Event) -> str:
+    if event.date:
+        return f"{event.title} ({event.date:%Y/%m/%d})"
+    return event.title
+
+
+def find_users(db, prefix: str, limit: int = LOOKUP_LIMIT):
+    q = db.query(User)
+    prefix = (prefix or "").strip()
+    if prefix:
+        q = q.filter(prefix_filter(User.employee_code, prefix))
+    return [{"id": u.id, "label": user_label(u)} for u in q.order_by(User.employee_code).limit(limit)]
+
+
+def find_events(db, prefix: str, limit: int = LOOKUP_LIMIT):
+    q = db.query(Event).filter(Event.is_deleted.is_(False))
+    prefix = (prefix or "").strip()
+    if prefix:
+        q = q.filter(prefix_filter(Event.title, prefix))
+    return [{"id": e.id, "label": event_label(e)} for e in q.order_by(Event.title).limit(limit)]
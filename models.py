@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Boolean
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Date, Time, Boolean
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from db import Base
@@ -12,6 +12,10 @@ class User(Base):
     password = Column(String, nullable=False)
     role = Column(String, nullable=False)  # 'admin' or 'user'
     stamps = Column(Integer, nullable=False, default=0, server_default="0")
+    # カレンダー配信（ical.py）: 購読URLのトークンと、参加状況が変わるたびに加算する版数
+    calendar_token = Column(String, nullable=True, unique=True, index=True)
+    participation_version = Column(Integer, nullable=False, default=0, server_default="0")
+    participation_updated_at = Column(DateTime, nullable=True)
 
     # relationships (optional usage)
     user_events = relationship("UserEvent", back_populates="user", cascade="all, delete-orphan")
@@ -22,9 +26,9 @@ class Event(Base):
     __tablename__ = "events"
 
     id = Column(Integer, primary_key=True, index=True)
-    title = Column(String, nullable=False)
+    title = Column(String, nullable=False, index=True)  # 管理画面の前方一致補完（lookup.py）用
     description = Column(String, nullable=True)
-    date = Column(String, nullable=True)  # simple string date like '2025-09-10'
+    date = Column(Date, nullable=True, index=True)  # 開催日（範囲検索用にインデックス）
     is_active = Column(Boolean, nullable=False, default=True, server_default="1")
     # イベント種別: 'single'（単発）, 'annual'（年間イベント）, 'practice'（年間の練習回）, 'survey'（アンケート・応募）
     event_type = Column(String, nullable=False, default="single", server_default="single")
@@ -32,12 +36,15 @@ class Event(Base):
     parent_event_id = Column(Integer, ForeignKey("events.id"), nullable=True)
     # 拡張フィールド
     location = Column(String, nullable=True)
-    start_time = Column(String, nullable=True)  # e.g. '10:00'
-    end_time = Column(String, nullable=True)    # e.g. '11:00'
+    start_time = Column(Time, nullable=True)  # e.g. 10:00
+    end_time = Column(Time, nullable=True)    # e.g. 11:00
     capacity = Column(Integer, nullable=True)   # 定員
     contact_name = Column(String, nullable=True)
     points = Column(Integer, nullable=False, default=1, server_default="1")
     notes = Column(String, nullable=True)
+    # 論理削除（一覧から除外し、参加記録は jobs.py purge-deleted-events でバッチ退避・削除）
+    is_deleted = Column(Boolean, nullable=False, default=False, server_default="0")
+    deleted_at = Column(DateTime, nullable=True)
 
     participants = relationship("UserEvent", back_populates="event", cascade="all, delete-orphan")
     parent = relationship("Event", remote_side=[id], backref="children")
@@ -52,11 +59,32 @@ class UserEvent(Base):
     joined_at = Column(DateTime, nullable=False, default=datetime.utcnow)
     approval_status = Column(String, nullable=False, default="pending", server_default="pending")  # pending/approved/rejected
     approved_at = Column(DateTime, nullable=True)
+    # 承認時に実際に付与したスタンプ数（集計・退避用。承認前・却下は 0）
+    stamps_awarded = Column(Integer, nullable=False, default=0, server_default="0")
 
     user = relationship("User", back_populates="user_events")
     event = relationship("Event", back_populates="participants")
 
 
+class UserEventArchive(Base):
+    """削除済みイベントの参加記録の退避先（スタンプ履歴の根拠・集計の再作成用に保持）。"""
+    __tablename__ = "user_events_archive"
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    id = Column(Integer, primary_key=True)
+    # 元の user_events.id（user_events の id は削除後に再利用され得るため主キーにしない）
+    user_event_id = Column(Integer, nullable=False, index=True)
+    user_id = Column(Integer, nullable=False, index=True)
+    event_id = Column(Integer, nullable=False, index=True)
+    event_title = Column(String, nullable=True)
+    event_type = Column(String, nullable=False)  # 月別集計の再作成用
+    joined_at = Column(DateTime, nullable=False)
+    approval_status = Column(String, nullable=False)
+    approved_at = Column(DateTime, nullable=True)
+    stamps_issued = Column(Integer, nullable=False, default=0, server_default="0")  # 承認時の付与スタンプ数
+    archived_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+
 class StampHistory(Base):
     __tablename__ = "stamp_histories"
 
@@ -88,8 +116,88 @@ class RewardRequest(Base):
     reward_id = Column(Integer, ForeignKey("rewards.id"), nullable=False)
     status = Column(String, nullable=False, default="pending", server_default="pending")
     created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    # 申請時に減算したスタンプ数（却下時の返還・集計に使う。景品の必要数が後で変わっても変えない）
+    stamps_spent = Column(Integer, nullable=False, default=0, server_default="0")
 
     user = relationship("User", back_populates="reward_requests")
     reward = relationship("Reward", back_populates="requests")
 
 
+
+
+# ===== 集計（ダッシュボード用ロールアップ。analytics.py で更新） =====
+class MonthlyParticipationStat(Base):
+    __tablename__ = "stat_participation_monthly"
+
+    month = Column(String, primary_key=True)       # 参加申請月 'YYYY-MM'
+    event_type = Column(String, primary_key=True)
+    joins = Column(Integer, nullable=False, default=0, server_default="0")
+    approved = Column(Integer, nullable=False, default=0, server_default="0")
+    rejected = Column(Integer, nullable=False, default=0, server_default="0")
+    stamps_issued = Column(Integer, nullable=False, default=0, server_default="0")
+    approval_seconds = Column(Integer, nullable=False, default=0, server_default="0")  # 申請→承認の所要秒数合計
+
+
+class MonthlyParticipant(Base):
+    """月ごとの参加申請者（参加者数を重複なく数えるための記録）。"""
+    __tablename__ = "stat_participant_user_monthly"
+
+    month = Column(String, primary_key=True)  # 参加申請月 'YYYY-MM'
+    user_id = Column(Integer, primary_key=True)
+
+
+class MonthlyParticipantStat(Base):
+    __tablename__ = "stat_participants_monthly"
+
+    month = Column(String, primary_key=True)  # 参加申請月 'YYYY-MM'
+    participants = Column(Integer, nullable=False, default=0, server_default="0")  # 参加申請したユーザー数（重複なし）
+
+
+class EventParticipationStat(Base):
+    __tablename__ = "stat_participation_event"
+
+    event_id = Column(Integer, ForeignKey("events.id"), primary_key=True)
+    joins = Column(Integer, nullable=False, default=0, server_default="0")
+    approved = Column(Integer, nullable=False, default=0, server_default="0")
+    rejected = Column(Integer, nullable=False, default=0, server_default="0")
+    stamps_issued = Column(Integer, nullable=False, default=0, server_default="0")
+    approval_seconds = Column(Integer, nullable=False, default=0, server_default="0")
+
+    event = relationship("Event")
+
+
+class MonthlyRedemptionStat(Base):
+    __tablename__ = "stat_redemption_monthly"
+
+    month = Column(String, primary_key=True)  # 交換申請月 'YYYY-MM'
+    requested = Column(Integer, nullable=False, default=0, server_default="0")
+    approved = Column(Integer, nullable=False, default=0, server_default="0")
+    rejected = Column(Integer, nullable=False, default=0, server_default="0")
+    stamps_spent = Column(Integer, nullable=False, default=0, server_default="0")
+
+
+class IdempotencyKey(Base):
+    """POST の再送（二重クリック・プロキシのリトライ）で同じ結果を返すための記録。"""
+    __tablename__ = "idempotency_keys"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    key = Column(String, primary_key=True)
+    location = Column(String, nullable=False)  # 初回のリダイレクト先
+    message = Column(String, nullable=False)   # 初回の flash メッセージ
+    category = Column(String, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+
+class PendingChange(Base):
+    """承認待ち（参加申請・景品交換申請）の追加・状態変更の記録。
+
+    init_db.create_pending_change_triggers のトリガーが書き込み、live.py が id をカーソルにして読む。
+    """
+    __tablename__ = "pending_changes"
+    __table_args__ = {"sqlite_autoincrement": True}  # 削除後も id を再利用しない（カーソルが戻らない）
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)  # 'user_event' / 'reward_request'
+    item_id = Column(Integer, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
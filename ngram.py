@@ -0,0 +1,29 @@
+"""イベント検索用の bigram 索引（events_fts_bigram）の語の作り方。
+
+trigram 索引（events_fts）では3文字未満の語（睡眠・練習など）を引けないため、本文を
+2文字ずつの語に分けたものを別の FTS5 テーブルに入れ、unicode61 で語ごとに索引する。
+db.py が index_text を SQLite の関数 fts_bigrams として登録し、init_db のトリガーから呼ぶ。
+"""
+from typing import Optional
+
+
+def index_text(text: Optional[str]) -> Optional[str]:
+    """本文を索引用の語の並びにする。
+
+    空白区切りの語ごとに、2文字ずつの語を順に並べたあとに1文字ずつの語を続ける
+    （例: "睡眠改善" -> "睡眠 眠改 改善 睡 眠 改 善"）。2文字ずつの語が連続しているため、
+    3文字以上の語も query_phrase のフレーズとして引ける。
+    """
+    if not text:
+        return text
+    tokens = []
+    for word in text.split():
+        tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+        tokens.extend(word)
+    return " ".join(tokens)
+
+
+def query_phrase(term: str) -> str:
+    """検索語を index_text と同じ語に分け、FTS5 のフレーズ（引用符付き）にする。"""
+    tokens = [term[i:i + 2] for i in range(len(term) - 1)] or [term]
+    return '"' + " ".join(tokens).replace('"', '""') + '"'
@@ -0,0 +1,175 @@
+"""リクエスト単位のプロファイル取得（管理者向け・オプトイン）。
+
+次のいずれかでリクエスト全体を cProfile で計測し、collapsed-stack 形式
+（flamegraph.pl / speedscope で読める形式）で PROFILE_DIR に保存する。
+
+- 管理者ログイン中に `X-Profile: 1` ヘッダーまたは `?_profile=1` を付ける
+- 環境変数 PROFILE_SAMPLE_RATE=N で N リクエストに1回をサンプリング（0 で無効）
+
+利用者の読み込み（auth.init_auth）も計測に含めるため、計測は init_auth より前に開始する。
+そのためヘッダー等による計測は開始時点では権限が分からず、保存時に g.user が管理者でなければ破棄する。
+
+保存先は最新 PROFILE_MAX_CAPTURES 件に制限し、古いものから削除する。
+各キャプチャには route・SQL件数・処理時間などを記録した .json を併せて保存する。
+"""
+import cProfile
+import json
+import os
+import pstats
+import random
+import time
+from collections import defaultdict
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Optional
+
+from flask import g, request, session
+from sqlalchemy import event
+
+from auth import is_admin
+
+# 計測中のリクエストでのみ SQL 件数を数える（list[int] を保持）
+_sql_counter: ContextVar[Optional[list]] = ContextVar("profile_sql_counter", default=None)
+
+# 出力が肥大化しないための上限（呼び出し経路は組み合わせで爆発するため）
+_MAX_DEPTH = 128
+_MIN_SECONDS = 10e-6  # これ未満しか按分されない経路は打ち切る
+
+
+def init_profiler(app, engine) -> None:
+    app.config.setdefault("PROFILE_DIR", os.environ.get("PROFILE_DIR", "profiles"))
+    app.config.setdefault("PROFILE_MAX_CAPTURES", int(os.environ.get("PROFILE_MAX_CAPTURES", "50")))
+    app.config.setdefault("PROFILE_SAMPLE_RATE", int(os.environ.get("PROFILE_SAMPLE_RATE", "0")))
+
+    if not event.contains(engine, "before_cursor_execute", _count_sql):
+        event.listen(engine, "before_cursor_execute", _count_sql)
+
+    @app.before_request
+    def start_profile():
+        trigger = _profile_trigger(app.config["PROFILE_SAMPLE_RATE"])
+        if trigger is None:
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # 別スレッドで計測中（同時に有効にできるプロファイラは1つ）
+            return None
+        g._profile = (profiler, trigger, time.perf_counter(), _sql_counter.set([0]))
+        return None
+
+    @app.teardown_request
+    def stop_profile(exception=None):
+        state = g.pop("_profile", None)
+        if state is None:
+            return
+        profiler, trigger, started, token = state
+        profiler.disable()
+        duration_ms = (time.perf_counter() - started) * 1000
+        sql_count = _sql_counter.get()[0]
+        _sql_counter.reset(token)
+        if trigger == "admin" and not (g.get("user") is not None and is_admin()):
+            return
+        try:
+            _save_capture(app, profiler, trigger, duration_ms, sql_count)
+        except OSError:
+            app.logger.exception("プロファイルの保存に失敗しました")
+
+
+def _profile_trigger(sample_rate: int) -> Optional[str]:
+    if request.headers.get("X-Profile") or request.args.get("_profile"):
+        # 利用者はまだ読み込まれていないため、ログイン中なら計測を始めて stop_profile で権限を確かめる
+        return "admin" if session.get("user_id") else None
+    if sample_rate > 0 and random.randrange(sample_rate) == 0:
+        return "sample"
+    return None
+
+
+def _count_sql(conn, cursor, statement, parameters, context, executemany):
+    counter = _sql_counter.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+def _save_capture(app, profiler, trigger: str, duration_ms: float, sql_count: int) -> None:
+    directory = app.config["PROFILE_DIR"]
+    os.makedirs(directory, exist_ok=True)
+    route = request.url_rule.rule if request.url_rule else request.path
+    name = "{}_{}_{}".format(
+        datetime.utcnow().strftime("%Y%m%dT%H%M%S%f"),
+        (request.endpoint or "unknown").replace(".", "-"),
+        int(duration_ms),
+    )
+    with open(os.path.join(directory, name + ".folded"), "w", encoding="utf-8") as f:
+        for stack, micros in collapse_stats(pstats.Stats(profiler)):
+            f.write(f"{stack} {micros}\n")
+    meta = {
+        "route": route,
+        "method": request.method,
+        "path": request.full_path,
+        "endpoint": request.endpoint,
+        "user_id": g.user.id if g.get("user") else None,
+        "trigger": trigger,
+        "duration_ms": round(duration_ms, 2),
+        "sql_count": sql_count,
+    }
+    with open(os.path.join(directory, name + ".json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    _rotate(directory, app.config["PROFILE_MAX_CAPTURES"])
+
+
+def _rotate(directory: str, keep: int) -> None:
+    captures = sorted(n[:-len(".folded")] for n in os.listdir(directory) if n.endswith(".folded"))
+    for name in captures[:max(len(captures) - keep, 0)]:
+        for ext in (".folded", ".json"):
+            try:
+                os.remove(os.path.join(directory, name + ext))
+            except FileNotFoundError:
+                pass
+
+
+def _label(func) -> str:
+    filename, line, name = func
+    if filename == "~":
+        return name  # 組み込み関数
+    return f"{name} ({os.path.basename(filename)}:{line})".replace(";", ",")
+
+
+def collapse_stats(stats: pstats.Stats):
+    """pstats の呼び出し元→呼び出し先の集計を collapsed-stack 行（スタック, マイクロ秒）に展開する。
+
+    cProfile は完全なスタックを持たないため、各関数の時間を呼び出し元ごとの
+    累積時間の比率で按分した近似になる。
+    """
+    callees = defaultdict(list)
+    for func, (_cc, _nc, _tt, _ct, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            # edge = (cc, nc, tt, ct)：この呼び出し元経由の時間
+            callees[caller].append((func, edge[3]))
+
+    # 計測開始前から実行中だったフレーム（Flask のディスパッチ等）は stats に無いので、
+    # 呼び出し元が stats に含まれない関数を根とする
+    roots = [
+        f for f, (_cc, _nc, _tt, _ct, callers) in stats.stats.items()
+        if not any(c in stats.stats for c in callers)
+    ]
+    out = defaultdict(int)
+
+    def walk(func, path, seen, budget):
+        _cc, _nc, tt, ct, _callers = stats.stats[func]
+        if ct <= 0 or budget < _MIN_SECONDS:
+            return
+        ratio = min(budget / ct, 1.0)
+        path = path + [_label(func)]
+        out[";".join(path)] += int(tt * ratio * 1_000_000)
+        if len(path) >= _MAX_DEPTH:
+            return
+        seen = seen | {func}
+        for child, edge_ct in callees.get(func, ()):
+            if child in seen:
+                continue  # 再帰呼び出しは1段に畳む
+            walk(child, path, seen, edge_ct * ratio)
+
+    for root in roots:
+        walk(root, [], frozenset(), stats.stats[root][3])
+    return [(stack, micros) for stack, micros in out.items() if micros > 0]
@@ -0,0 +1,76 @@
+"""景品交換申請の承認・却下（複数件まとめて処理）。
+
+件数によらず一定数の SQL で処理する。却下時は交換申請で減算したスタンプ（stamps_spent）を返還する。
+commit は呼び出し側で行う。
+"""
+from datetime import datetime
+from typing import Iterable, List
+
+from sqlalchemy import func, insert, literal, select, update
+
+import analytics
+from models import Reward, RewardRequest, StampHistory, User
+
+
+def _pending(request_ids: Iterable[int]):
+    return select(RewardRequest.id).where(
+        RewardRequest.id.in_(set(request_ids)),
+        RewardRequest.status == "pending",
+    )
+
+
+def _set_status(db, pending, status: str) -> List[int]:
+    # 保留中のものだけを対象にするため、必ず最後に実行する。更新した申請のユーザーIDを申請ごとに返す
+    return db.scalars(
+        update(RewardRequest)
+        .where(RewardRequest.id.in_(pending))
+        .values(status=status)
+        .returning(RewardRequest.user_id)
+        .execution_options(synchronize_session=False)
+    ).all()
+
+
+def approve_requests(db, request_ids: Iterable[int]) -> int:
+    """保留中の申請を承認する（SQL 2文）。処理件数を返す。"""
+    pending = _pending(request_ids)
+    analytics.record_redemption_decisions(db, pending, "approved")
+    return len(_set_status(db, pending, "approved"))
+
+
+def reject_requests(db, request_ids: Iterable[int]) -> List[int]:
+    """保留中の申請を却下し、スタンプを返還する（SQL 4文）。
+
+    却下した申請のユーザーID（申請ごと。件数は len で数える）を返す。
+    """
+    pending = _pending(request_ids)
+    analytics.record_redemption_decisions(db, pending, "rejected")
+
+    # 返還履歴を一括登録
+    db.execute(
+        insert(StampHistory).from_select(
+            ["user_id", "change", "reason", "created_at"],
+            select(
+                RewardRequest.user_id,
+                RewardRequest.stamps_spent,
+                literal("景品交換却下による返還: ") + Reward.name,
+                literal(datetime.utcnow()),
+            )
+            .join(Reward, Reward.id == RewardRequest.reward_id)
+            .where(RewardRequest.id.in_(pending)),
+        )
+    )
+
+    # ユーザーごとの返還合計で残高を更新
+    refund = (
+        select(func.sum(RewardRequest.stamps_spent))
+        .where(RewardRequest.user_id == User.id, RewardRequest.id.in_(pending))
+        .scalar_subquery()
+    )
+    db.execute(
+        update(User)
+        .where(User.id.in_(select(RewardRequest.user_id).where(RewardRequest.id.in_(pending))))
+        .values(stamps=User.stamps + refund)
+        .execution_options(synchronize_session=False)
+    )
+
+    return _set_status(db, pending, "rejected")
@@ -0,0 +1,79 @@
+from typing import List, Optional, Tuple
+
+from sqlalchemy import column, table, text
+
+from models import Event
+from ngram import query_phrase
+
+
+# init_db.create_event_search_index で作成する FTS5 仮想テーブル（rowid = events.id）
+events_fts = table("events_fts", column("rowid"), column("rank"), column("events_fts"))
+# 本文を2文字ずつに分けた索引（3文字未満の語を含む検索用。ngram.py 参照）
+events_fts_bigram = table("events_fts_bigram", column("rowid"), column("rank"), column("events_fts_bigram"))
+
+# trigram トークナイザで索引を引ける最小文字数（これより短い語を含む検索は events_fts_bigram で引く）
+MIN_TERM_LENGTH = 3
+
+# 関連度順に並べる最大ヒット件数。これを超える場合は関連度を計算せず、索引の順（登録の新しい順）に読む
+RANK_LIMIT = 1000
+
+# 検索用テーブルの有無（FTS5・trigram 非対応の SQLite では init_db が作成をスキップする）
+_fts_available: Optional[bool] = None
+
+
+def split_terms(text: str) -> Tuple[List[str], List[str]]:
+    """空白区切りの検索語を (trigram で引ける語, 短い語) に分ける。"""
+    terms = (text or "").split()
+    return [t for t in terms if len(t) >= MIN_TERM_LENGTH], [t for t in terms if len(t) < MIN_TERM_LENGTH]
+
+
+def to_match_query(text: str) -> Optional[str]:
+    """入力文字列を events_fts の MATCH 式に変換（空白区切りの AND 検索）。
+
+    各語はフレーズとして引用するため、利用者が FTS5 の演算子を入力しても構文エラーにならない。
+    索引を引けない短い語は除外し、検索語が残らなければ None。
+    """
+    terms, _ = split_terms(text)
+    if not terms:
+        return None
+    return " ".join('"' + t.replace('"', '""') + '"' for t in terms)
+
+
+def to_bigram_match_query(text: str) -> Optional[str]:
+    """入力文字列を events_fts_bigram の MATCH 式に変換（空白区切りの AND 検索。短い語も含む）。"""
+    terms = (text or "").split()
+    if not terms:
+        return None
+    return " ".join(query_phrase(t) for t in terms)
+
+
+def fts_available(db) -> bool:
+    global _fts_available
+    if _fts_available is None:
+        names = db.execute(
+            text("SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ('events_fts', 'events_fts_bigram')")
+        ).scalars().all()
+        _fts_available = len(names) == 2
+    return _fts_available
+
+
+def search_events(q, keyword: str):
+    """Event のクエリをキーワードで絞り込んで並べる（fts_available の場合のみ呼ぶこと）。
+
+    すべての語が3文字以上なら events_fts、短い語を含むなら events_fts_bigram で全語を引く
+    （1回の MATCH で絞り込む）。ヒットが RANK_LIMIT 件以下なら関連度（bm25）順、
+    それより多ければ関連度を計算せず登録の新しい順に並べる（件数は打ち切らない）。
+    """
+    _, short_terms = split_terms(keyword)
+    if short_terms:
+        fts, match = events_fts_bigram, to_bigram_match_query(keyword)
+    else:
+        fts, match = events_fts, to_match_query(keyword)
+    q = q.join(fts, fts.c.rowid == Event.id).filter(fts.c[fts.name].match(match))
+
+    # 件数は RANK_LIMIT + 1 件目まで数えれば足りる
+    hits = q.with_entities(Event.id).limit(RANK_LIMIT + 1).count()
+    if hits > RANK_LIMIT:
+        # rowid の降順は FTS5 の索引をそのまま逆順に読めるため、表示するページ分だけ読めばよい
+        return q.order_by(fts.c.rowid.desc())
+    return q.order_by(fts.c.rank)
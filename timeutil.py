@@ -0,0 +1,30 @@
+from datetime import date, datetime, time
+from typing import Optional
+
+
+def parse_date(value) -> Optional[date]:
+    """'YYYY-MM-DD'（'YYYY/MM/DD' も可）を date に変換。空・不正値は None。"""
+    if value is None or isinstance(value, date):
+        return value
+    s = str(value).strip().replace("/", "-")
+    if not s:
+        return None
+    try:
+        return datetime.strptime(s[:10], "%Y-%m-%d").date()
+    except ValueError:
+        return None
+
+
+def parse_time(value) -> Optional[time]:
+    """'HH:MM' / 'HH:MM:SS'（小数秒付きも可）を time に変換。空・不正値は None。"""
+    if value is None or isinstance(value, time):
+        return value
+    s = str(value).strip()
+    if not s:
+        return None
+    for fmt in ("%H:%M:%S.%f", "%H:%M:%S", "%H:%M"):
+        try:
+            return datetime.strptime(s, fmt).time()
+        except ValueError:
+            continue
+    return None
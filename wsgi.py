@@ -0,0 +1,22 @@
+"""本番用 WSGI エントリポイント（gunicorn -c gunicorn.conf.py で起動）。
+
+gunicorn の preload_app でマスタープロセスが1回だけ import する。
+スキーマ確認（create_app 内の ensure_db）とキャッシュの事前構築もここで済ませ、
+フォーク後の各ワーカーは copy-on-write で共有する。
+"""
+from sqlalchemy.orm import configure_mappers
+
+from app import app
+from db import engine
+
+
+def warm_up() -> None:
+    # マッパー設定とテンプレートのコンパイルを初回リクエスト前に済ませる
+    configure_mappers()
+    for name in app.jinja_env.list_templates(extensions=["html"]):
+        app.jinja_env.get_template(name)
+    # マスターで開いた接続をワーカーに引き継がない
+    engine.dispose()
+
+
+warm_up()